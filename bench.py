@@ -0,0 +1,224 @@
+"""Offline benchmarks for nanocoder's own overhead, separate from model latency.
+
+Runs stream_chat against local stand-in OpenAI (SSE) and Bedrock (binary event stream) servers that replay a
+response at a configurable token rate, plus parse_aws_event_stream, StreamRenderer/render_md, get_map on
+synthetic git repos, apply_edits and build_messages. Each benchmark runs in its own interpreter so its peak RSS is
+its own. Prints one JSON document (also written with --out) so results can be compared across VERSION bumps.
+
+    python3 bench.py                       # default sizes 100, 1000, 10000 files
+    python3 bench.py --sizes 100,100000 --rate 200 --out bench_output.txt
+"""
+import argparse, contextlib, http.server, io, json, os, platform, resource, shutil, statistics, struct, subprocess, sys, tempfile, threading, time, zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import nanocoder
+
+SAMPLE = """Here is the change. It **renames** the helper and keeps `run` as an alias.
+
+## Plan
+1. Update *callers*
+2. Keep the [docs](https://example.com) in sync
+
+```python
+def run(cmd):
+    return subprocess.check_output(cmd, shell=True)
+```
+<edit path="pkg/mod_1.py">
+<find>def func_1():</find>
+<replace>def func_1(verbose=False):</replace>
+</edit>
+<commit_message>Rename helper</commit_message>
+"""
+
+def tokens(text, count):
+    """Split text into ~4-char pieces and repeat until count tokens."""
+    pieces = [text[i:i + 4] for i in range(0, len(text), 4)]
+    return [pieces[i % len(pieces)] for i in range(count)]
+
+def load_replay(path):
+    """A recorded Bedrock event stream (raw .eventstream bytes), SSE capture (data: lines) or plain response text.
+    Returns (chunks or None, text, raw event-stream messages or None)."""
+    data = Path(path).read_bytes()
+    if len(data) >= 12 and zlib.crc32(data[:8]) == struct.unpack_from(">I", data, 8)[0]:  # valid event-stream prelude
+        chunks = [payload["delta"].get("text") or "" for event, payload in nanocoder.parse_aws_event_stream(io.BytesIO(data)) if event == "contentBlockDelta"]
+        events, start = [], 0
+        while start < len(data): events.append(data[start:start + struct.unpack_from(">I", data, start)[0]]); start += len(events[-1])
+        return chunks, "".join(chunks), events
+    text = data.decode()
+    if not text.startswith("data: "): return None, text, None
+    chunks = []
+    for line in text.splitlines():
+        if line.startswith("data: ") and line != "data: [DONE]":
+            try: chunks.append(json.loads(line[6:])["choices"][0]["delta"].get("content") or "")
+            except (ValueError, KeyError, IndexError): pass
+    return chunks, "".join(chunks), None
+
+def aws_message(event, payload, message_type="event"):
+    def header(name, value): name, value = name.encode(), value.encode(); return bytes([len(name)]) + name + b"\x07" + struct.pack(">H", len(value)) + value
+    headers = header(":event-type", event) + header(":content-type", "application/json") + header(":message-type", message_type)
+    body = json.dumps(payload).encode()
+    prelude = struct.pack(">II", 12 + len(headers) + len(body) + 4, len(headers))
+    message = prelude + struct.pack(">I", zlib.crc32(prelude)) + headers + body
+    return message + struct.pack(">I", zlib.crc32(message))
+
+def aws_stream(chunks):
+    yield aws_message("messageStart", {"role": "assistant"})
+    for chunk in chunks: yield aws_message("contentBlockDelta", {"contentBlockIndex": 0, "delta": {"text": chunk}})
+    yield aws_message("messageStop", {"stopReason": "end_turn"})
+    yield aws_message("metadata", {"usage": {"inputTokens": 1000, "outputTokens": len(chunks), "cacheReadInputTokens": 900}, "metrics": {"latencyMs": 1}})
+
+def sse_stream(chunks):
+    for chunk in chunks: yield b"data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": chunk}}]}).encode() + b"\n\n"
+    yield b"data: " + json.dumps({"choices": [], "usage": {"prompt_tokens": 1000, "completion_tokens": len(chunks), "prompt_tokens_details": {"cached_tokens": 900}}}).encode() + b"\n\n"
+    yield b"data: [DONE]\n\n"
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for /chat/completions and /model/<id>/converse-stream, chunked, keep-alive.
+    Bedrock replays the recorded messages verbatim when events is set."""
+    protocol_version, chunks, ttft, rate, events = "HTTP/1.1", [], 0.0, 0.0, None
+    def log_message(self, *args): pass
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        bedrock = self.path.endswith("/converse-stream")
+        self.send_response(200); self.send_header("Content-Type", "application/vnd.amazon.eventstream" if bedrock else "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked"); self.end_headers()
+        time.sleep(self.ttft)
+        for i, part in enumerate((self.events or aws_stream(self.chunks)) if bedrock else sse_stream(self.chunks)):
+            if self.rate and i: time.sleep(1 / self.rate)
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(part), part))
+        self.wfile.write(b"0\r\n\r\n")
+
+@contextlib.contextmanager
+def mock_server(chunks, ttft, rate, events=None):
+    handler = type("Handler", (MockHandler,), {"chunks": chunks, "ttft": ttft, "rate": rate, "events": events})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try: yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally: server.shutdown(); server.server_close()
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter(); result = fn(*args, **kwargs); return time.perf_counter() - start, result
+
+def isolated(fn, *args):
+    """Run fn(*args) in a fresh interpreter and add that process's peak RSS to its result dict."""
+    import multiprocessing
+    ctx = multiprocessing.get_context("spawn")
+    receiver, sender = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_measure, args=(sender, fn, args)); process.start(); sender.close()
+    try: result, rss = receiver.recv()
+    except EOFError: process.join(); raise RuntimeError(f"{fn.__name__} failed (exit code {process.exitcode})") from None
+    process.join()
+    return {**result, "peak_rss_mb": round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)}
+
+def _measure(sender, fn, args):
+    result = fn(*args); sender.send((result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def bench_stream(chunks, ttft, rate, runs, events=None):
+    """Client-side overhead of stream_chat: wall time minus what the mock server spends waiting."""
+    first_feed, original_feed = [], nanocoder.StreamRenderer.feed
+    def feed(self, chunk):
+        if not first_feed: first_feed.append(time.perf_counter())
+        return original_feed(self, chunk)
+    results = {}
+    nanocoder.StreamRenderer.feed = feed
+    try:
+        with mock_server(chunks, ttft, rate, events) as url:
+            # "amazonaws.com" in the base URL path is what routes stream_chat to the Bedrock code path
+            for name, base in (("openai", f"{url}/v1"), ("bedrock", f"{url}/amazonaws.com")):
+                os.environ.update(OPENAI_API_KEY="bench", OPENAI_BASE_URL=base)
+                ttfts, overheads = [], []
+                for _ in range(runs):
+                    first_feed.clear()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        start = time.perf_counter(); nanocoder.stream_chat([{"role": "user", "content": "bench"}], "anthropic.bench"); elapsed = time.perf_counter() - start
+                    ttfts.append((first_feed[0] - start - ttft) * 1000 if first_feed else None)
+                    overheads.append((elapsed - ttft - (len(chunks) / rate if rate else 0)) * 1000)
+                results[name] = {"ttft_overhead_ms_first": round(ttfts[0], 3), "ttft_overhead_ms_median": round(statistics.median(ttfts[1:] or ttfts), 3),
+                                 "stream_overhead_ms_median": round(statistics.median(overheads[1:] or overheads), 3), "tokens": len(chunks)}
+    finally: nanocoder.StreamRenderer.feed = original_feed
+    return results
+
+def bench_event_stream(chunks):
+    data = b"".join(aws_stream(chunks))
+    elapsed, events = timed(lambda: sum(1 for _ in nanocoder.parse_aws_event_stream(io.BytesIO(data))))
+    return {"events": events, "bytes": len(data), "seconds": round(elapsed, 4), "mb_per_s": round(len(data) / elapsed / 1e6, 2)}
+
+def bench_render(chunks):
+    sink = io.StringIO()
+    def render():
+        renderer = nanocoder.StreamRenderer(sink)
+        for chunk in chunks: renderer.feed(chunk)
+        renderer.finish()
+    elapsed, _ = timed(render)
+    md_elapsed, _ = timed(lambda: [nanocoder.render_md(p) for p in "".join(chunks).split("\n\n")])
+    return {"tokens": len(chunks), "tokens_per_s": round(len(chunks) / elapsed), "render_md_chars_per_s": round(sum(map(len, chunks)) / md_elapsed)}
+
+def git(root, *args): subprocess.run(["git", "-C", str(root), "-c", "user.name=bench", "-c", "user.email=bench@localhost", *args], check=True, capture_output=True)
+
+def make_repo(root, files):
+    """Synthetic repo: Python and JS modules in nested packages that call into each other."""
+    root.mkdir(parents=True)
+    for i in range(files):
+        path = root / f"pkg{i % 50}" / f"sub{i % 7}" / (f"mod_{i}.py" if i % 4 else f"mod_{i}.js")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        calls = [(i * 7919 + k * 104729) % files for k in range(4)]
+        if path.suffix == ".py": path.write_text(f"import os\n\ndef func_{i}(x):\n    return " + " + ".join(f"func_{c}(x)" for c in calls) + f"\n\nclass Model{i}:\n    pass\n")
+        else: path.write_text(f"export function func_{i}(x) {{\n  return " + " + ".join(f"func_{c}(x)" for c in calls) + ";\n}\n")
+    git(root, "init", "-q"); git(root, "add", "-A"); git(root, "commit", "-qm", "init")
+
+def bench_map(root):
+    nanocoder._MAP_CACHE.clear(); shutil.rmtree(nanocoder.cache_dir(root), ignore_errors=True)
+    cold, _ = timed(nanocoder.get_map, root, (), "func_1")
+    warm, _ = timed(nanocoder.get_map, root, (), "func_1")
+    personalized, _ = timed(nanocoder.get_map, root, ("pkg1/sub1/mod_1.py",), "func_2")
+    nanocoder._MAP_CACHE.clear()
+    disk, _ = timed(nanocoder.get_map, root, (), "func_1")
+    with open(root / "pkg1" / "sub1" / "mod_1.py", "a") as f: f.write("\ndef extra():\n    pass\n")
+    dirty, _ = timed(nanocoder.get_map, root, (), "func_1")
+    subprocess.run(["git", "-C", str(root), "checkout", "-q", "--", "."], check=True)
+    return {"cold_s": round(cold, 4), "warm_s": round(warm, 5), "personalized_s": round(personalized, 4), "disk_cache_s": round(disk, 4), "one_file_changed_s": round(dirty, 4)}
+
+def bench_edits(root, edits, files):
+    targets = [p.relative_to(root).as_posix() for p in sorted(root.rglob("mod_*.py"))[:files]]
+    blocks = "".join(f'<edit path="{targets[k % len(targets)]}">\n<find>class Model{Path(targets[k % len(targets)]).stem[4:]}:</find>\n<replace>class Model{Path(targets[k % len(targets)]).stem[4:]}:\n    """Edited {k}."""</replace>\n</edit>\n' for k in range(edits))
+    cwd = os.getcwd(); os.chdir(root)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()): elapsed, (changed, _) = timed(nanocoder.apply_edits, blocks + "<commit_message>bench</commit_message>", str(root))
+    finally: os.chdir(cwd)
+    return {"edits": edits, "files": len(changed), "seconds": round(elapsed, 4)}
+
+def bench_context(root, files):
+    context_files = {p.relative_to(root).as_posix() for p in sorted(root.rglob("mod_*.py"))[:files]}
+    cold, (_, _, seen) = timed(nanocoder.build_messages, str(root), context_files, [], "func_3")
+    warm, _ = timed(nanocoder.build_messages, str(root), context_files, [], "func_3", seen)
+    return {"files": len(context_files), "cold_s": round(cold, 4), "warm_s": round(warm, 4)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma-separated synthetic repo sizes (files)")
+    parser.add_argument("--tokens", type=int, default=2000, help="tokens per mock response")
+    parser.add_argument("--rate", type=float, default=0, help="mock server tokens/s (0 = as fast as possible)")
+    parser.add_argument("--ttft", type=float, default=0.05, help="mock server delay before the first token (s)")
+    parser.add_argument("--runs", type=int, default=5, help="stream_chat runs per endpoint")
+    parser.add_argument("--replay", help="recorded Bedrock .eventstream, SSE capture or response text to replay instead of the built-in sample")
+    parser.add_argument("--out", help="also write the JSON results to this file")
+    args = parser.parse_args()
+    recorded, text, events = load_replay(args.replay) if args.replay else (None, SAMPLE, None)
+    chunks = recorded or tokens(text, args.tokens)
+    os.environ.setdefault("NANOCODER_WARMUP", "0")
+    results = {"version": nanocoder.VERSION, "python": platform.python_version(), "platform": platform.platform(), "time": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+    results["baseline_rss_mb"] = isolated(dict)["peak_rss_mb"]  # interpreter + imports, included in every peak_rss_mb below
+    results["stream_chat"] = isolated(bench_stream, chunks, args.ttft, args.rate, args.runs, events)
+    results["event_stream"] = isolated(bench_event_stream, tokens(text, 50_000))
+    results["render"] = isolated(bench_render, tokens(text, 200_000))
+    results["repos"] = {}
+    with tempfile.TemporaryDirectory(prefix="nanocoder-bench-") as tmp:
+        for size in (int(s) for s in args.sizes.split(",") if s):
+            root = Path(tmp, f"repo{size}"); make_repo(root, size)
+            results["repos"][size] = {"get_map": isolated(bench_map, root), "apply_edits": isolated(bench_edits, root, 40, 10), "build_messages": isolated(bench_context, root, 30)}
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.out: Path(args.out).write_text(output + "\n")
+
+if __name__ == "__main__": main()
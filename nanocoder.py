@@ -1,8 +1,8 @@
 VERSION = 50
-TAGS = {"edit": "edit", "find": "find", "replace": "replace", "request": "request_files", "drop": "drop_files", "commit": "commit_message", "shell": "shell_command", "create": "create"}
-SYSTEM_PROMPT = f'You are a coding expert. Answer any questions the user might have. Only code if the user asks you to, and use this XML format:\n[{TAGS["edit"]} path="file.py"]\n[{TAGS["find"]}]lines to find[/{TAGS["find"]}]\n[{TAGS["replace"]}]new code[/{TAGS["replace"]}]\n[/{TAGS["edit"]}]\nThe [{TAGS["find"]}] text is replaced literally, so it must match exactly. Keep it short - only enough lines to be unambiguous. Split large changes into multiple small edits.\nTo delete, leave [{TAGS["replace"]}] empty. To create a new file: [{TAGS["create"]} path="new_file.py"]file content[/{TAGS["create"]}].\nTo request files (one path per line):\n[{TAGS["request"]}]\npath/file1.py\npath/file2.py\n[/{TAGS["request"]}]\nTo drop files from context (one path per line):\n[{TAGS["drop"]}]\npath/file.py\n[/{TAGS["drop"]}]\nTo run a shell command: [{TAGS["shell"]}]echo hi[/{TAGS["shell"]}]. The tool will ask the user to approve (y/n). After running, the shell output will be returned truncated (first 10 lines, then a TRUNCATED marker, then the last 40 lines; full output if <= 50 lines).\nWhen making edits provide a [{TAGS["commit"]}]...[/{TAGS["commit"]}].\nOnly use one [{TAGS["shell"]}] command per response. Wait for the result before running another.'.replace('[', '<').replace(']', '>')
+TAGS = {"edit": "edit", "find": "find", "replace": "replace", "request": "request_files", "drop": "drop_files", "commit": "commit_message", "shell": "shell_command", "create": "create", "search": "search_code"}
+SYSTEM_PROMPT = f'You are a coding expert. Answer any questions the user might have. Only code if the user asks you to, and use this XML format:\n[{TAGS["edit"]} path="file.py"]\n[{TAGS["find"]}]lines to find[/{TAGS["find"]}]\n[{TAGS["replace"]}]new code[/{TAGS["replace"]}]\n[/{TAGS["edit"]}]\nThe [{TAGS["find"]}] text is replaced literally, so it must match exactly. Keep it short - only enough lines to be unambiguous. Split large changes into multiple small edits.\nTo delete, leave [{TAGS["replace"]}] empty. To create a new file: [{TAGS["create"]} path="new_file.py"]file content[/{TAGS["create"]}].\nTo request files (one path per line):\n[{TAGS["request"]}]\npath/file1.py\npath/file2.py\n[/{TAGS["request"]}]\nTo drop files from context (one path per line):\n[{TAGS["drop"]}]\npath/file.py\n[/{TAGS["drop"]}]\nTo search the repo instead of requesting whole files (one literal, case-insensitive string per line; returns ranked snippets with line numbers):\n[{TAGS["search"]}]\ndef parse_config\n[/{TAGS["search"]}]\nTo run a shell command: [{TAGS["shell"]}]echo hi[/{TAGS["shell"]}]. The tool will ask the user to approve (y/n). After running, the shell output will be returned truncated (first 10 lines, then a TRUNCATED marker, then the last 40 lines; full output if <= 50 lines).\nWhen making edits provide a [{TAGS["commit"]}]...[/{TAGS["commit"]}].\nOnly use one [{TAGS["shell"]}] command per response. Wait for the result before running another.'.replace('[', '<').replace(']', '>')
 
-import ast, difflib, glob, json, os, re, struct, subprocess, sys, threading, time, urllib.request, urllib.error, platform, shutil, datetime
+import collections, contextlib, glob, itertools, json, os, re, stat, struct, subprocess, sys, threading, time, shutil, datetime, zlib  # heavier modules are imported where first used
 from pathlib import Path
 
 def ansi(code): return f"\033[{code}"
@@ -10,18 +10,77 @@ def styled(text, style): return f"{ansi(style)}{text}{ansi('0m')}"
 def run(shell_cmd):
     try: return subprocess.check_output(shell_cmd, shell=True, text=True, stderr=subprocess.STDOUT).strip()
     except: return None
-_TMUX_WIN = run("tmux display-message -p '#{window_id}' 2>/dev/null")
-def title(t): print(f"\033]0;{t}\007", end="", flush=True); _TMUX_WIN and run(f"tmux rename-window -t {_TMUX_WIN} {t!r} 2>/dev/null")
-_CACHED_SYSTEM_INFO = None
+_TMUX_WIN = None  # looked up on first title() call, only when running inside tmux
+def title(t):
+    global _TMUX_WIN
+    print(f"\033]0;{t}\007", end="", flush=True)
+    if _TMUX_WIN is None: _TMUX_WIN = os.environ.get("TMUX") and run("tmux display-message -p '#{window_id}' 2>/dev/null") or ""
+    _TMUX_WIN and run(f"tmux rename-window -t {_TMUX_WIN} {t!r} 2>/dev/null")
+TRACE_FILE = os.getenv("NANOCODER_TRACE")  # append one JSON line of phase spans per round trip
+_TRACE, _STATS, _STATS_LOCK = threading.local(), {}, threading.Lock()  # current turn per thread; phase -> [seconds]
+_SESSION = f"{os.getpid():x}{int(time.time()):x}"
+
+def record_span(name, seconds, **attrs):
+    """Record a timed phase for the current turn and the session totals shown by /stats."""
+    with _STATS_LOCK:
+        _STATS.setdefault(name, []).append(seconds)
+        if attrs.get("tokens_per_s"): _STATS.setdefault("tokens/s", []).append(attrs["tokens_per_s"])
+    if (turn := getattr(_TRACE, "turn", None)) is not None: turn["spans"].append({"name": name, "ms": round(seconds * 1000, 2), **attrs})
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    start = time.perf_counter()
+    try: yield attrs  # callers may add attributes (sizes, counts) while the span is open
+    finally: record_span(name, time.perf_counter() - start, **attrs)
+
+def begin_turn(**attrs): _TRACE.turn = {"ts": round(time.time(), 3), "session": _SESSION, "version": VERSION, **attrs, "spans": [], "start": time.perf_counter()}
+
+def end_turn():
+    if (turn := getattr(_TRACE, "turn", None)) is None: return
+    _TRACE.turn = None; turn["total_ms"] = round((time.perf_counter() - turn.pop("start")) * 1000, 2)
+    record_span("turn", turn["total_ms"] / 1000)
+    if TRACE_FILE:
+        try:
+            with open(TRACE_FILE, "a") as f: f.write(json.dumps(turn, separators=(',',':')) + "\n")
+        except OSError as e: print(styled(f"Trace write failed: {e}", "31m"))
+
+def show_stats():
+    with _STATS_LOCK: stats = {name: sorted(values) for name, values in _STATS.items()}
+    if not stats: print("No stats yet."); return
+    print(styled(f"{'phase':<16}{'n':>5}{'total':>10}{'mean':>10}{'p50':>10}{'max':>10}", "1m"))
+    for name, values in stats.items():
+        if name == "tokens/s": continue
+        print(f"{name:<16}{len(values):>5}" + "".join(f"{v * 1000:>8.0f}ms" for v in (sum(values), sum(values) / len(values), values[len(values) // 2], values[-1])))
+    if rates := stats.get("tokens/s"): print(f"{'tokens/s':<16}{len(rates):>5}{'':>10}{sum(rates) / len(rates):>10.1f}{rates[len(rates) // 2]:>10.1f}{rates[-1]:>10.1f}")
+
+_CACHED_SYSTEM_INFO, _SYSTEM_INFO_LOCK = None, threading.Lock()
 def system_summary():
+    """Environment summary for the model. Tool versions are probed in parallel and cached on disk,
+    keyed by PATH and the mtimes of the probed binaries."""
     global _CACHED_SYSTEM_INFO
-    if _CACHED_SYSTEM_INFO: return _CACHED_SYSTEM_INFO
-    try:
-        tools = ["apt","bash","curl","docker","gcc","git","make","node","npm","perl","pip","python3","sh","tar","unzip","wget","zip"]
-        versions = {tool: (run(f"{tool} --version") or "").split('\n')[0][:80] for tool in ["git","python3","pip","node","npm","docker","gcc"] if shutil.which(tool)}
-        _CACHED_SYSTEM_INFO = {"os": platform.system(), "release": platform.release(), "machine": platform.machine(), "python": sys.version.split()[0], "cwd": os.getcwd(), "shell": os.environ.get("SHELL") or os.environ.get("ComSpec") or "", "path": os.environ.get("PATH", ""), "venv": bool(os.environ.get("VIRTUAL_ENV") or sys.prefix != sys.base_prefix), "tools": [tool for tool in tools if shutil.which(tool)], "versions": {key: val for key, val in versions.items() if val}}
-    except: _CACHED_SYSTEM_INFO = {}
-    return _CACHED_SYSTEM_INFO
+    with _SYSTEM_INFO_LOCK:
+        if _CACHED_SYSTEM_INFO is not None: return _CACHED_SYSTEM_INFO
+        try:
+            import platform
+            tools = ["apt","bash","curl","docker","gcc","git","make","node","npm","perl","pip","python3","sh","tar","unzip","wget","zip"]
+            found = {tool: path for tool in tools if (path := shutil.which(tool))}
+            probed = [tool for tool in ["git","python3","pip","node","npm","docker","gcc"] if tool in found]
+            key, cache_file = [os.environ.get("PATH", ""), [[tool, found[tool], os.stat(found[tool]).st_mtime_ns] for tool in probed]], user_cache_dir() / "system.json"
+            if (cached := load_json(cache_file, {})).get("key") == key: versions = cached.get("versions", {})
+            else:
+                versions = {}
+                def probe(tool):
+                    try: result = subprocess.run([found[tool], "--version"], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=10)
+                    except (OSError, subprocess.SubprocessError): return
+                    if result.returncode == 0 and (line := result.stdout.strip().split('\n')[0][:80]): versions[tool] = line
+                threads = [threading.Thread(target=probe, args=(tool,), daemon=True) for tool in probed]
+                for thread in threads: thread.start()
+                for thread in threads: thread.join()
+                versions = {tool: versions[tool] for tool in probed if tool in versions}
+                save_json(cache_file, {"key": key, "versions": versions})
+            _CACHED_SYSTEM_INFO = {"os": platform.system(), "release": platform.release(), "machine": platform.machine(), "python": sys.version.split()[0], "cwd": os.getcwd(), "shell": os.environ.get("SHELL") or os.environ.get("ComSpec") or "", "path": os.environ.get("PATH", ""), "venv": bool(os.environ.get("VIRTUAL_ENV") or sys.prefix != sys.base_prefix), "tools": list(found), "versions": versions}
+        except: _CACHED_SYSTEM_INFO = {}
+        return _CACHED_SYSTEM_INFO
 
 def load_agents_md(root):
     agents_path = Path(root, "AGENTS.md")
@@ -33,50 +92,86 @@ def load_agents_md(root):
 MAX_FILE_SIZE = 100 * 1024  # 100KB
 MAX_LINE_LENGTH = 500  # characters per line
 
-def safe_read_file(path, root=None, confirm_large=False):
+FILE_CACHE_BYTES = 64 * 1024 * 1024  # LRU budget for cached file contents
+_FILE_CACHE, _FILE_CACHE_LOCK, _FILE_CACHE_SIZE = collections.OrderedDict(), threading.Lock(), [0]  # path -> ((mtime_ns, size, ino), content)
+
+def _cache_put(path, key, content):
+    with _FILE_CACHE_LOCK:
+        if (old := _FILE_CACHE.pop(path, None)): _FILE_CACHE_SIZE[0] -= len(old[1])
+        _FILE_CACHE[path] = (key, content); _FILE_CACHE_SIZE[0] += len(content)
+        while _FILE_CACHE_SIZE[0] > FILE_CACHE_BYTES and len(_FILE_CACHE) > 1: _FILE_CACHE_SIZE[0] -= len(_FILE_CACHE.popitem(last=False)[1][1])
+
+def read_cached(path, st=None, store=True):
+    """Read a text file through the shared content cache, revalidated by (mtime_ns, size, inode).
+    With store=False a miss is read without being added, so one-off scans don't evict the working set."""
+    path = os.fspath(path); st = st or os.stat(path)
+    key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    with _FILE_CACHE_LOCK:
+        hit = _FILE_CACHE.get(path)
+        if hit and hit[0] == key: _FILE_CACHE.move_to_end(path); return hit[1]
+    content = Path(path).read_text()
+    if store: _cache_put(path, key, content)
+    return content
+
+_UMASK = os.umask(0o022); os.umask(_UMASK)
+
+def write_cached(path, content):
+    """Atomically write a text file (temp file + rename, keeping the file mode) and update the content cache.
+    A symlink is written through: the temp file and rename target the file it points to, not the link."""
+    path = Path(path)
+    if path.is_symlink(): path = path.resolve()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f: f.write(content)
+        try: mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError: mode = 0o666 & ~_UMASK
+        os.chmod(tmp, mode); os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError): os.unlink(tmp)
+        raise
+    st = os.stat(path); _cache_put(os.fspath(path), (st.st_mtime_ns, st.st_size, st.st_ino), content)
+
+def safe_read_file(path, root=None, confirm_large=False, store=True):
     """Safely read a file with size, symlink, and special file checks. Returns (content, error_msg)."""
     p = Path(path) if root is None else Path(root, path)
-    if not p.exists(): return None, "not found"
+    try: st = os.lstat(p)
+    except FileNotFoundError: return None, "not found"
+    except OSError as e: return None, f"cannot stat: {e}"
     # Check for symlinks
-    if p.is_symlink():
+    if stat.S_ISLNK(st.st_mode):
         try:
             target = p.resolve()
             root_path = Path(root).resolve() if root else Path.cwd().resolve()
             if not str(target).startswith(str(root_path)):
                 return None, f"symlink points outside repo: {target}"
+            st = os.stat(p)
+        except FileNotFoundError: return None, "not found"
         except (OSError, ValueError) as e:
             return None, f"symlink error: {e}"
     # Check for special files (not regular files)
-    try:
-        stat_result = p.stat()
-        import stat
-        mode = stat_result.st_mode
-        if not stat.S_ISREG(mode):
-            return None, "special file (not regular)"
-    except OSError as e:
-        return None, f"cannot stat: {e}"
+    if not stat.S_ISREG(st.st_mode):
+        return None, "special file (not regular)"
     # Check file size
-    try:
-        size = p.stat().st_size
-        if size > MAX_FILE_SIZE:
-            size_kb = size / 1024
-            size_str = f"{size_kb:.1f}KB" if size_kb < 1024 else f"{size_kb/1024:.1f}MB"
-            if confirm_large:
-                print(f"{styled(f'Warning: {path} is {size_str} (>{MAX_FILE_SIZE//1024}KB)', '93m')}")
-                try:
-                    answer = input("Load anyway? (y/n): ").strip().lower()
-                except (EOFError, KeyboardInterrupt):
-                    print()
-                    answer = "n"
-                if answer != "y":
-                    return None, f"skipped (too large: {size_str})"
-            else:
-                return None, f"file too large: {size_str}"
-    except OSError as e:
-        return None, f"cannot check size: {e}"
+    size = st.st_size
+    if size > MAX_FILE_SIZE:
+        size_kb = size / 1024
+        size_str = f"{size_kb:.1f}KB" if size_kb < 1024 else f"{size_kb/1024:.1f}MB"
+        if confirm_large:
+            print(f"{styled(f'Warning: {path} is {size_str} (>{MAX_FILE_SIZE//1024}KB)', '93m')}")
+            try:
+                answer = input("Load anyway? (y/n): ").strip().lower()
+            except (EOFError, KeyboardInterrupt):
+                print()
+                answer = "n"
+            if answer != "y":
+                return None, f"skipped (too large: {size_str})"
+        else:
+            return None, f"file too large: {size_str}"
     # Try to read the file
     try:
-        content = p.read_text()
+        content = read_cached(p, st, store)
         return content if content else "[empty]", None
     except PermissionError:
         return None, "permission denied"
@@ -85,72 +180,567 @@ def safe_read_file(path, root=None, confirm_large=False):
     except OSError as e:
         return None, f"read error: {e}"
 
-def get_map(root, max_files=100):
-    BINARY_EXT = {'.png','.jpg','.jpeg','.gif','.ico','.webp','.bmp','.mp3','.mp4','.wav','.avi','.mov','.zip','.tar','.gz','.rar','.7z','.pdf','.exe','.dll','.so','.dylib','.pyc','.woff','.woff2','.ttf','.eot'}
-    EXCLUDE_DIRS = {'.git', 'node_modules', '__pycache__', 'venv', '.venv', '.tox', 'dist', 'build', '.eggs', '.mypy_cache', '.pytest_cache', '.ruff_cache', 'htmlcov', '.coverage', 'env', '.env'}
-    files = (run(f"git -C {root} ls-files") or "").splitlines()
-    if not files:
-        files, rp = [], Path(root)
+def user_cache_dir(): return Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache", "nanocoder")
+
+def cache_dir(root):
+    """Per-repo cache directory: inside .git when available (shared by linked worktrees), else under ~/.cache/nanocoder."""
+    git = Path(root, ".git")
+    if git.is_dir(): return git / "nanocoder"
+    try:  # linked worktree: .git is a "gitdir: <repo>/.git/worktrees/<name>" file whose commondir points back at the main .git
+        gitdir = Path(root, git.read_text().split("gitdir:", 1)[1].strip())
+        return (gitdir / Path(gitdir, "commondir").read_text().strip()).resolve() / "nanocoder"
+    except (OSError, IndexError): pass
+    import hashlib
+    return user_cache_dir() / hashlib.sha1(str(Path(root).resolve()).encode()).hexdigest()[:12]
+
+def load_json(path, default):
+    try: return json.loads(Path(path).read_text())
+    except: return default
+
+def save_json(path, data):
+    try:
+        path = Path(path); path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"); tmp.write_text(json.dumps(data, separators=(',',':'))); os.replace(tmp, path)
+    except OSError: pass
+
+def open_db(root, name):
+    """sqlite database in the repo's cache dir, for caches too large to rewrite whole on every change."""
+    import sqlite3
+    path = cache_dir(root) / name; path.parent.mkdir(parents=True, exist_ok=True)
+    return contextlib.closing(sqlite3.connect(path, timeout=30))
+
+def git_state(root):
+    """Cheap fingerprint of the tree: HEAD oid, index state and stat of every dirty tracked file.
+    Returns (signature, dirty_paths); signature is None outside git."""
+    status = run(f"git -C {root} status --porcelain=v2 --branch --untracked-files=no")
+    if status is None: return None, set()
+    sig, dirty = [], set()
+    for line in status.splitlines():
+        kind, path = line[:1], None
+        if kind == "1": path = line.split(" ", 8)[-1]
+        elif kind == "2": path = line.split(" ", 9)[-1].split("\t")[0]
+        elif kind == "u": path = line.split(" ", 10)[-1]
+        if path: dirty.add(path)
+        try: st = os.stat(Path(root, path)) if path else None; sig.append((line, st and (st.st_mtime_ns, st.st_size)))
+        except OSError: sig.append((line, None))
+    return tuple(sig), dirty
+
+MAP_TOKENS = 2048  # repo map budget (~4 chars per token)
+MAP_DEADLINE = 0.5  # seconds allowed for ranking
+MAP_BUILD_DEADLINE = 0.5  # seconds of symbol extraction and linking per call; the rest continues in a background thread
+MAP_PUSH_EPSILON = 3e-5  # residual below which personalized rank stops spreading from a file
+MAP_INCREMENTAL_MAX = 2000  # changed paths applied one by one; more than this re-lists the whole tree
+MAP_MAX_FILES = 100_000
+MAP_MAX_DEFINERS = 12  # names defined in more files than this are too generic to link on
+SYMBOL_CACHE_VERSION = 3
+_MAP_CACHE = {}  # root -> {"lock", "sig", "head", "dirty", "keys", "symbols", "files", "index", "definers", "graph", "todo", "unlinked", "affected", "key", "map"}
+_JS_DEFS = r'^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?(?:function\*?|class|interface|type|enum|const|let|var)\s+([A-Za-z_$][\w$]*)'
+_JAVA_DEFS = r'^\s*(?:(?:public|private|protected|internal|static|final|abstract|sealed|open|data|partial)\s+)*(?:class|interface|enum|record|object|struct|fun)\s+([A-Za-z_]\w*)'
+_C_DEFS = r'^(?:struct|class|enum|union|namespace)\s+([A-Za-z_]\w*)|^(?:[A-Za-z_][\w\*&:<>, ]*?[ \*&])?([A-Za-z_]\w*)\s*\([^;]*$'
+SYMBOL_PATTERNS = {**dict.fromkeys(('.js', '.jsx', '.ts', '.tsx', '.mjs', '.cjs'), _JS_DEFS), **dict.fromkeys(('.java', '.kt', '.cs', '.scala'), _JAVA_DEFS), **dict.fromkeys(('.c', '.h', '.cc', '.cpp', '.hpp', '.cxx'), _C_DEFS),
+    '.py': r'^(?:async\s+)?(?:def|class)\s+([A-Za-z_]\w*)', '.go': r'^(?:func(?:\s*\([^)]*\))?|type)\s+([A-Za-z_]\w*)', '.rs': r'^\s*(?:pub(?:\([^)]*\))?\s+)?(?:async\s+)?(?:fn|struct|enum|trait|type|mod|const|static)\s+([A-Za-z_]\w*)',
+    '.rb': r'^\s*(?:def\s+(?:self\.)?|class\s+|module\s+)([A-Za-z_]\w*[?!]?)', '.php': r'^\s*(?:(?:public|private|protected|static|abstract|final)\s+)*(?:function|class|interface|trait)\s+([A-Za-z_]\w*)',
+    '.swift': r'^\s*(?:(?:public|private|internal|open|fileprivate|static|final)\s+)*(?:func|class|struct|enum|protocol)\s+([A-Za-z_]\w*)', '.sh': r'^\s*(?:function\s+)?([A-Za-z_][\w-]*)\s*\(\)'}
+SYMBOL_RE = {ext: re.compile(pattern, re.MULTILINE) for ext, pattern in SYMBOL_PATTERNS.items()}
+IDENT_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]{2,}')
+
+def extract_symbols(path, text):
+    """Return (defs, refs): definitions in file order, and the most frequent identifiers it uses."""
+    ext, defs = path.suffix.lower(), []
+    if ext == '.py':
+        import ast
+        try: defs = [n.name for n in ast.parse(text).body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))]
+        except (SyntaxError, ValueError): defs = None
+    if not defs and ext in SYMBOL_RE: defs = list(dict.fromkeys(next(g for g in m.groups() if g) for m in SYMBOL_RE[ext].finditer(text)))
+    counts = {}
+    for ident in IDENT_RE.findall(text): counts[ident] = counts.get(ident, 0) + 1
+    own = set(defs or ())
+    return defs or [], [ident for ident in sorted(counts, key=counts.get, reverse=True) if ident not in own][:64]
+
+def load_symbols(root):
+    """Stored symbols: path -> [key, defs, refs]. Empty when missing, unreadable or from another cache version."""
+    import sqlite3
+    try:
+        with open_db(root, "symbols.db") as db, db:
+            if db.execute("PRAGMA user_version").fetchone()[0] != SYMBOL_CACHE_VERSION:
+                db.execute("DROP TABLE IF EXISTS symbols"); db.execute(f"PRAGMA user_version = {SYMBOL_CACHE_VERSION}")
+            db.execute("CREATE TABLE IF NOT EXISTS symbols (path TEXT PRIMARY KEY, key TEXT, defs TEXT, refs TEXT) WITHOUT ROWID")
+            return {f: [key, defs.split(), refs.split()] for f, key, defs, refs in db.execute("SELECT path, key, defs, refs FROM symbols")}
+    except (sqlite3.Error, OSError): return {}
+
+def save_symbols(root, changed, removed=()):
+    """Write only the changed entries (and drop removed paths), so an edit costs a few rows, not the whole cache."""
+    import sqlite3
+    try:
+        with open_db(root, "symbols.db") as db, db:
+            db.executemany("INSERT OR REPLACE INTO symbols VALUES (?, ?, ?, ?)", ((f, key, " ".join(defs), " ".join(refs)) for f, (key, defs, refs) in changed.items()))
+            db.executemany("DELETE FROM symbols WHERE path = ?", ((f,) for f in removed))
+    except (sqlite3.Error, OSError): pass
+
+def personalized_rank(graph, definers, index, focus, idents, deadline):
+    """PageRank personalized toward the focus files and files defining identifiers from the request, as {index: score}.
+    Computed by local push: work is bounded by MAP_PUSH_EPSILON, not by the size of the repo. Empty without seeds."""
+    seeds = {index[f] for f in focus if f in index}
+    seeds |= {index[g] for name in idents for g in definers.get(name, ())[:MAP_MAX_DEFINERS]}
+    if not seeds: return {}
+    pers = {i: 1 / len(seeds) for i in seeds}
+    score, residual, queue, pushes = {}, dict(pers), collections.deque(pers), 0
+    while queue and (pushes % 1024 or time.monotonic() < deadline):
+        u = queue.popleft(); r, outs = residual[u], graph[u]; pushes += 1
+        if r <= MAP_PUSH_EPSILON * max(len(outs), 1): continue
+        residual[u], score[u] = 0.0, score.get(u, 0.0) + 0.15 * r
+        for v, share in ((v, 0.85 * r / len(outs)) for v in outs) if outs else ((s, 0.85 * r * w) for s, w in pers.items()):  # dangling: back to the seeds
+            old = residual.get(v, 0.0); residual[v] = old + share
+            if old <= MAP_PUSH_EPSILON * max(len(graph[v]), 1) < old + share: queue.append(v)
+    for i, p in pers.items(): score[i] = score.get(i, 0.0) + p  # seeds themselves come first
+    return score
+
+def global_rank(files, graph, deadline):
+    """Plain PageRank over the live files, for requests without seeds. Returns file indices, best first."""
+    n, live = len(files), sum(f is not None for f in files)
+    pers = [1 / live if f is not None else 0.0 for f in files] if live else []
+    rank = pers[:]
+    for _ in range(20):
+        nxt, dangling = [0.0] * n, 0.0
+        for i, outs in enumerate(graph):
+            if outs:
+                share = 0.85 * rank[i] / len(outs)
+                for j in outs: nxt[j] += share
+            else: dangling += rank[i]
+        rest = 0.15 + 0.85 * dangling
+        nxt = [r + rest * p for r, p in zip(nxt, pers)]
+        delta, rank = sum(abs(a - b) for a, b in zip(nxt, rank)), nxt
+        if delta < 1e-6 or time.monotonic() > deadline: break
+    return sorted(range(n), key=rank.__getitem__, reverse=True)  # stable: ties keep shallow-first order
+
+BINARY_EXT = {'.png','.jpg','.jpeg','.gif','.ico','.webp','.bmp','.mp3','.mp4','.wav','.avi','.mov','.zip','.tar','.gz','.rar','.7z','.pdf','.exe','.dll','.so','.dylib','.pyc','.woff','.woff2','.ttf','.eot'}
+EXCLUDE_DIRS = {'.git', 'node_modules', '__pycache__', 'venv', '.venv', '.tox', 'dist', 'build', '.eggs', '.mypy_cache', '.pytest_cache', '.ruff_cache', 'htmlcov', '.coverage', 'env', '.env'}
+
+def list_files(root, dirty):
+    """Repo files -> cache key: blob oid for clean tracked files, "mtime:size" for dirty ones (or outside git)."""
+    entries = {}
+    for line in (run(f"git -C {root} ls-files -s") or "").splitlines():
+        meta, _, f = line.partition("\t")
+        if not meta.startswith("160000"): entries[f] = meta.split()[1]
+    if not entries:
+        rp = Path(root)
         for dirpath, dirnames, filenames in os.walk(root, followlinks=False):
             dirnames[:] = sorted(d for d in dirnames if d not in EXCLUDE_DIRS)
-            files.extend(str(Path(dirpath, f).relative_to(rp)) for f in sorted(filenames))
-            if len(files) >= max_files * 2: break
-    files = sorted(files, key=lambda f: (f.count('/'), f))[:max_files]
-    output = []
+            entries.update((str(Path(dirpath, f).relative_to(rp)), None) for f in sorted(filenames))
+            if len(entries) >= MAP_MAX_FILES: break
+    files = {}
+    for f, oid in list(entries.items())[:MAP_MAX_FILES]:
+        if oid is None or f in dirty:
+            try: st = os.stat(Path(root, f)); oid = f"{st.st_mtime_ns}:{st.st_size}"
+            except OSError: continue
+        files[f] = oid
+    return files
+
+def map_names(f, defs):
+    """Names a file can be linked by: its definitions and its file stem."""
+    base = f.rpartition('/')[2]
+    return defs + [base.rpartition('.')[0] or base]
+
+def map_reset(root, cache, entries):
+    """Lay out the map state for a full listing (path -> key). Extraction and linking are queued, not done here."""
+    if "symbols" not in cache: cache["symbols"] = load_symbols(root)
+    symbols = cache["symbols"]
+    if removed := symbols.keys() - entries.keys():
+        for f in removed: del symbols[f]
+        save_symbols(root, {}, removed)
+    files, definers = sorted(entries, key=lambda f: (f.count('/'), f)), {}
     for f in files:
-        p = Path(root, f)
-        if not p.exists(): continue
-        if p.suffix.lower() in BINARY_EXT: output.append(f"{f} [binary]"); continue
-        defs = ""
-        if f.endswith('.py'):
-            try: defs = ": " + ", ".join(n.name for n in ast.parse(p.read_text()).body if isinstance(n, (ast.FunctionDef, ast.ClassDef)))[:80]
-            except: pass
-        output.append(f"{f}{defs}")
-    return "\n".join(output)
-
-TAG_COLORS = {TAGS["shell"]: '46;30m', TAGS["find"]: '41;37m', TAGS["replace"]: '42;30m', TAGS["commit"]: '44;37m', TAGS["request"]: '45;37m', TAGS["drop"]: '45;37m', TAGS["edit"]: '43;30m', TAGS["create"]: '43;30m'}
+        for name in map_names(f, symbols[f][1] if f in symbols else []): definers.setdefault(name, []).append(f)
+    cache.update(keys=dict(entries), files=files, index={f: i for i, f in enumerate(files)}, definers=definers, graph=[[] for _ in files],
+        todo={f: k for f, k in entries.items() if f not in symbols or symbols[f][0] != k}, unlinked=set(range(len(files))), affected=set(), key=None, order=None)
+
+def map_apply(root, cache, changes):
+    """Apply path -> new key (None = gone) to the map state: tombstone removed files, append new ones, queue changed ones."""
+    symbols, definers, files, index, keys = cache["symbols"], cache["definers"], cache["files"], cache["index"], cache["keys"]
+    removed = []
+    for f, key in changes.items():
+        if key is None:
+            if f not in index: continue
+            i = index.pop(f); files[i], cache["graph"][i] = None, []; keys.pop(f, None); cache["todo"].pop(f, None)
+            for name in map_names(f, symbols[f][1] if f in symbols else []):
+                if f in (d := definers.get(name, ())): d.remove(f); cache["affected"].add(name)
+            if symbols.pop(f, None): removed.append(f)
+            continue
+        if f not in index:
+            index[f] = len(files); files.append(f); cache["graph"].append([]); cache["unlinked"].add(index[f])
+            for name in map_names(f, symbols[f][1] if f in symbols else []): definers.setdefault(name, []).append(f); cache["affected"].add(name)
+        keys[f] = key
+        if f not in symbols or symbols[f][0] != key: cache["todo"][f] = key
+        else: cache["todo"].pop(f, None)
+    if removed: save_symbols(root, {}, removed)
+    cache.update(key=None, order=None)
+
+def map_changes(root, cache, sig, dirty):
+    """Paths that may differ since the last sync (dirty now or before, or changed between the two HEADs) -> new key.
+    Returns None when that can't be told cheaply and the tree has to be listed again."""
+    head = next((line[13:] for line, _ in sig if line.startswith("# branch.oid ")), None)
+    candidates = dirty | cache["dirty"]
+    if head != cache["head"]:
+        if not head or not cache["head"] or head == "(initial)": return None
+        diff = subprocess.run(["git", "-C", str(root), "diff", "--name-only", "--no-renames", "-z", cache["head"], head], capture_output=True, text=True)
+        if diff.returncode: return None
+        candidates |= set(diff.stdout.split("\0")) - {""}
+    if len(candidates) > MAP_INCREMENTAL_MAX: return None
+    listed = {}
+    if candidates:
+        ls = subprocess.run(["git", "--literal-pathspecs", "-C", str(root), "ls-files", "-s", "-z", "--", *sorted(candidates)], capture_output=True, text=True)
+        if ls.returncode: return None
+        for record in filter(None, ls.stdout.split("\0")):
+            meta, _, f = record.partition("\t")
+            if not meta.startswith("160000"): listed[f] = meta.split()[1]
+    changes = {}
+    for f in candidates:
+        key = listed.get(f)
+        if key is not None and f in dirty:
+            try: st = os.stat(Path(root, f)); key = f"{st.st_mtime_ns}:{st.st_size}"
+            except OSError: key = None
+        if key != cache["keys"].get(f): changes[f] = key
+    return changes
+
+def map_work(root, cache, deadline):
+    """Extract symbols of queued files and relink the files they affect, until deadline. Returns True if anything changed."""
+    symbols, definers, files, index, graph, todo, unlinked, affected = (cache[k] for k in ("symbols", "definers", "files", "index", "graph", "todo", "unlinked", "affected"))
+    changed = {}
+    while todo and time.monotonic() < deadline:
+        f, key = todo.popitem()
+        p, defs, refs = Path(root, f), [], []
+        if p.suffix.lower() == '.py' or p.suffix.lower() in SYMBOL_RE:
+            try: defs, refs = extract_symbols(p, p.read_text()) if p.stat().st_size <= MAX_FILE_SIZE else ([], [])
+            except (OSError, UnicodeDecodeError): pass
+        old_defs, old_refs = symbols[f][1:] if f in symbols else ([], [])
+        if defs != old_defs:
+            for name in old_defs: definers[name].remove(f)
+            for name in defs: definers.setdefault(name, []).append(f)
+            affected.update(set(defs) ^ set(old_defs))
+        if refs != old_refs: unlinked.add(index[f])
+        symbols[f] = changed[f] = [key, defs, refs]
+    if changed: save_symbols(root, changed)
+    if affected:  # files referring to a name whose definers changed need their links recomputed
+        if len(unlinked) < len(index):
+            for i, f in enumerate(files):
+                if f is not None and f in symbols and not affected.isdisjoint(symbols[f][2]): unlinked.add(i)
+        for name in [n for n in affected if not definers.get(n)]: definers.pop(name, None)
+        affected.clear()
+    linked = 0
+    while unlinked and (linked % 256 or time.monotonic() < deadline):
+        i = unlinked.pop(); f = files[i]; linked += 1
+        if f is None: continue
+        targets = {g for r in (symbols[f][2] if f in symbols else ()) if (d := definers.get(r)) and len(d) <= MAP_MAX_DEFINERS for g in d}
+        graph[i] = [index[g] for g in targets if g != f]
+    if changed or linked: cache.update(key=None, order=None)
+    return bool(changed or linked)
+
+def map_background(root, cache):
+    """Finish queued extraction and linking off the request path, in short slices so get_map never waits long for the lock."""
+    def work():
+        while True:
+            with cache["lock"]:
+                if not (cache["todo"] or cache["unlinked"] or cache["affected"]): return
+                map_work(root, cache, time.monotonic() + 0.05)
+            time.sleep(0.001)
+    if not (cache.get("worker") and cache["worker"].is_alive()):
+        cache["worker"] = threading.Thread(target=work, daemon=True); cache["worker"].start()
+
+def get_map(root, focus=(), request="", budget=MAP_TOKENS):
+    """Repo map ranked by relevance to the focus files and request, rendered to fit the token budget.
+    Changes since the last call are applied incrementally; extraction and linking past MAP_BUILD_DEADLINE continue
+    in the background, so a cold or heavily changed tree gives a partial (less well ranked) map instead of a stall."""
+    started, cache = time.monotonic(), _MAP_CACHE.setdefault(str(root), {"lock": threading.Lock()})
+    with cache["lock"]:
+        sig, dirty = git_state(root)
+        focus, idents = set(focus), set(IDENT_RE.findall(request))
+        key = (frozenset(focus), frozenset(idents), budget)
+        if sig is None or cache.get("sig") != sig:
+            changes = map_changes(root, cache, sig, dirty) if sig is not None and "files" in cache else None
+            if changes is None: entries = list_files(root, dirty)
+            if changes is None and "files" in cache and len(cache["files"]) - len(cache["index"]) < max(1000, len(cache["index"]) // 10):
+                changes = {f: k for f, k in entries.items() if cache["keys"].get(f) != k} | {f: None for f in cache["keys"].keys() - entries.keys()}
+            if changes is None: map_reset(root, cache, entries)
+            elif changes: map_apply(root, cache, changes)
+            cache.update(sig=sig, dirty=dirty, head=sig and next((line[13:] for line, _ in sig if line.startswith("# branch.oid ")), None))
+        if cache["todo"] or cache["unlinked"] or cache["affected"]:
+            map_work(root, cache, started + MAP_BUILD_DEADLINE)
+            if cache["todo"] or cache["unlinked"] or cache["affected"]: map_background(root, cache)
+        if cache.get("key") == key: return cache["map"]
+        files, symbols = cache["files"], cache["symbols"]
+        if rank := personalized_rank(cache["graph"], cache["definers"], cache["index"], focus, idents, time.monotonic() + MAP_DEADLINE):
+            order = itertools.chain(sorted(rank, key=lambda i: (-rank[i], i)), (i for i in range(len(files)) if i not in rank))  # unreached files: shallow first
+        else:
+            if cache.get("order") is None: cache["order"] = global_rank(files, cache["graph"], time.monotonic() + MAP_DEADLINE)
+            order = cache["order"]
+        output, used = [], 0
+        for i in order:
+            f = files[i]
+            if f is None or f in focus: continue
+            defs = symbols[f][1] if f in symbols else []
+            line = f"{f} [binary]" if Path(f).suffix.lower() in BINARY_EXT else f"{f}: {', '.join(defs)[:80]}" if defs else f
+            used += len(line) // 4 + 1
+            if used > budget: break
+            output.append(line)
+        cache.update(key=key, map="\n".join(output))
+        return cache["map"]
+
+SEARCH_MAX_MATCHES = 40  # matching lines returned per search block
+SEARCH_PER_FILE = 6
+SEARCH_CONTEXT = 2  # lines shown around each match
+SEARCH_CHARS = 8000  # ~2k tokens of snippets per search block
+SEARCH_DEF_RE = re.compile(r'\b(?:def|class|function|func|fn|struct|interface|trait|enum|type|module|const|let|var)\s+[*&]?$')
+SEARCH_INDEX_VERSION = 2
+_SEARCH_CACHE = {}  # root -> {"sig", "files": {path: key}, "blooms": {key: int}}
+
+def trigram_bloom(data):
+    """Bloom filter of the byte trigrams in data (UTF-8 of str.lower() text): ~8 bits per distinct trigram, power-of-two sized."""
+    grams = {data[i:i + 3] for i in range(len(data) - 2)}
+    shift = 32 - max(10, (len(grams) * 8 - 1).bit_length())
+    bits = bytearray(1 << (32 - shift) >> 3)
+    for g in grams:
+        h = (int.from_bytes(g, "little") * 0x9E3779B1 & 0xFFFFFFFF) >> shift; bits[h >> 3] |= 1 << (h & 7)
+    return int.from_bytes(bits, "little") | 1 << (len(bits) * 8)  # top sentinel bit records the filter size
+
+def search_index(root):
+    """Trigram blooms for every repo file, kept in a sqlite db next to the repo and updated incrementally.
+    Blooms are keyed by blob oid (or path + stat for dirty files) so linked worktrees share one index."""
+    cache, (sig, dirty) = _SEARCH_CACHE.setdefault(str(root), {}), git_state(root)
+    if sig is not None and cache.get("sig") == sig: return cache
+    files = {f: key if ":" not in key else f"{f}:{key}" for f, key in list_files(root, dirty).items() if Path(f).suffix.lower() not in BINARY_EXT}
+    blooms, wanted = cache.get("blooms", {}), set(files.values())
+    with open_db(root, "search.db") as db, db:
+        if db.execute("PRAGMA user_version").fetchone()[0] != SEARCH_INDEX_VERSION:
+            db.execute("DROP TABLE IF EXISTS blooms"); db.execute(f"PRAGMA user_version = {SEARCH_INDEX_VERSION}"); blooms = {}
+        db.execute("CREATE TABLE IF NOT EXISTS blooms (key TEXT PRIMARY KEY, bits BLOB) WITHOUT ROWID")
+        if missing := wanted - blooms.keys():
+            for key, bits in db.execute("SELECT key, bits FROM blooms"):
+                if key in missing: blooms[key] = int.from_bytes(bits, "little"); missing.discard(key)
+        added = []
+        for f, key in files.items():
+            if key not in missing: continue
+            try:
+                p = Path(root, f); data = p.read_bytes() if p.stat().st_size <= MAX_FILE_SIZE else b"\0"  # not via read_cached: a full scan would flush the content cache
+            except OSError: continue
+            try: bloom = 0 if b"\0" in data[:8192] else trigram_bloom(data.decode().lower().encode())  # same lowering as the query and line scan
+            except UnicodeDecodeError: bloom = 0  # safe_read_file would refuse it anyway
+            blooms[key] = bloom; missing.discard(key); added.append((key, bloom.to_bytes((bloom.bit_length() + 7) // 8, "little")))
+        db.executemany("INSERT OR REPLACE INTO blooms VALUES (?, ?)", added)
+        if db.execute("SELECT COUNT(*) FROM blooms").fetchone()[0] > 2 * len(wanted) + 1000:  # prune content no longer in this tree
+            db.execute("CREATE TEMP TABLE live (key TEXT PRIMARY KEY)"); db.executemany("INSERT INTO live VALUES (?)", ((k,) for k in wanted))
+            db.execute("DELETE FROM blooms WHERE key NOT IN (SELECT key FROM live)")
+    cache.update(sig=sig, files=files, blooms={k: b for k, b in blooms.items() if k in wanted})
+    return cache
+
+def search_code(root, query):
+    """Case-insensitive literal search over the repo. Returns ranked snippets with line numbers (grep style: N: match, N- context)."""
+    index, needle = search_index(root), query.lower()
+    data, masks = needle.encode(), {}
+    hits = []  # (score, path, lines, matching line numbers)
+    for f, key in index["files"].items():
+        if not (bloom := index["blooms"].get(key)): continue
+        if len(data) >= 3:
+            size = bloom.bit_length() - 1
+            if (mask := masks.get(size)) is None:
+                shift, mask = 32 - size.bit_length() + 1, 0
+                for i in range(len(data) - 2): mask |= 1 << ((int.from_bytes(data[i:i + 3], "little") * 0x9E3779B1 & 0xFFFFFFFF) >> shift)
+                masks[size] = mask
+            if bloom & mask != mask: continue
+        content, error = safe_read_file(f, root, store=len(data) >= 3)  # too short for the Bloom filter: every file is a candidate, don't cache them all
+        if error: continue
+        lines = content.splitlines()
+        matched = [n for n, line in enumerate(lines) if needle in line.lower()]
+        if not matched: continue
+        defs = sum(bool(SEARCH_DEF_RE.search(lines[n][:lines[n].lower().index(needle)])) for n in matched)
+        hits.append((defs * 10 + min(len(matched), 10) - f.count('/') * 0.1, f, lines, matched))
+    if not hits: return f"No matches for {query!r}."
+    hits.sort(key=lambda h: (-h[0], h[1]))
+    total, out, shown, used = sum(len(h[3]) for h in hits), [], 0, 0
+    for _, f, lines, matched in hits:
+        block, last, is_match = [f"{f}:"], -1, set(matched)
+        for n in matched[:SEARCH_PER_FILE]:
+            start = max(n - SEARCH_CONTEXT, last + 1)
+            if last >= 0 and start > last + 1: block.append("--")
+            for k in range(start, min(n + SEARCH_CONTEXT + 1, len(lines))): block.append(f"{k + 1}{':' if k in is_match else '-'} {lines[k][:MAX_LINE_LENGTH]}"); last = k
+        text = "\n".join(block)
+        if used + len(text) > SEARCH_CHARS or shown >= SEARCH_MAX_MATCHES: break
+        out.append(text); used += len(text); shown += min(len(matched), SEARCH_PER_FILE)
+    more = f"\n[{total - shown} more matches not shown; refine the search]" if total > shown else ""
+    return f"{total} matches for {query!r} in {len(hits)} files:\n" + "\n\n".join(out) + more
+
+def run_searches(response, root):
+    """Run every search_code block in a response (one query per line). Returns the combined results, or ''."""
+    results = []
+    for block in re.findall(rf'<{TAGS["search"]}>(.*?)</{TAGS["search"]}>', response, re.DOTALL):
+        for query in filter(None, (q.strip() for q in block.strip().split("\n"))):
+            with span("search") as attrs: results.append(search_code(root, query)); attrs["chars"] = len(results[-1])
+            print(styled(results[-1].split("\n", 1)[0], "90m"))
+    return "\n\n".join(results)
+
+TAG_COLORS = {TAGS["shell"]: '46;30m', TAGS["find"]: '41;37m', TAGS["replace"]: '42;30m', TAGS["commit"]: '44;37m', TAGS["request"]: '45;37m', TAGS["drop"]: '45;37m', TAGS["edit"]: '43;30m', TAGS["create"]: '43;30m', TAGS["search"]: '45;37m'}
 def get_tag_color(tag): return next((c for t, c in TAG_COLORS.items() if t in tag), None)
 
 def is_bedrock(url): return url and "amazonaws.com" in url
 
-def parse_aws_event_stream(response):
-    """Parse AWS binary event stream, yielding text chunks"""
-    buffer = b""
+HTTP_TIMEOUT = 300  # seconds without data before a request fails
+HTTP_RETRIES = 4  # retries for 429/5xx and dropped connections
+HTTP_BACKOFF, HTTP_BACKOFF_MAX = 1.0, 60.0  # seconds; doubled per attempt, with jitter
+HTTP_RETRY_BUDGET = 180  # seconds a request may spend on failed attempts and backoff before the error is raised
+HTTP_RETRY_STATUS = {408, 429, 500, 502, 503, 504, 529}
+_POOL, _POOL_LOCK = {}, threading.Lock()  # (scheme, host, port) -> idle keep-alive connections
+
+def _pool_key(url):
+    import urllib.parse
+    u = urllib.parse.urlsplit(url)
+    return u.scheme, u.hostname, u.port or (443 if u.scheme == "https" else 80)
+
+def _connect(scheme, host, port):
+    import http.client, urllib.parse, urllib.request
+    proxy = urllib.request.getproxies().get(scheme)
+    if proxy and not urllib.request.proxy_bypass(host):
+        pu = urllib.parse.urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+        import base64
+        auth = {"Proxy-Authorization": "Basic " + base64.b64encode(f"{urllib.parse.unquote(pu.username)}:{urllib.parse.unquote(pu.password or '')}".encode()).decode()} if pu.username else {}
+        conn = (http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection)(pu.hostname, pu.port or 8080, timeout=HTTP_TIMEOUT)
+        if scheme == "https": conn.set_tunnel(host, port, headers=auth)
+        conn.absolute_url = scheme != "https"  # plain-http proxies want the full URL as request target
+        conn.proxy_headers = {} if scheme == "https" else auth  # sent on the CONNECT for https, on every request for http
+        return conn
+    conn = (http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection)(host, port, timeout=HTTP_TIMEOUT)
+    conn.absolute_url, conn.proxy_headers = False, {}
+    return conn
+
+def _acquire(key):
+    with _POOL_LOCK:
+        if idle := _POOL.get(key): return idle.pop(), True
+    return _connect(*key), False
+
+def _release(key, conn):
+    with _POOL_LOCK: _POOL.setdefault(key, []).append(conn)
+
+def warm_up(url):
+    """Open a pooled connection (TCP + TLS) in the background so the next request skips the handshake."""
+    key = _pool_key(url)
+    with _POOL_LOCK:
+        if _POOL.get(key): return
+    def connect():
+        try: conn = _connect(*key); conn.connect(); _release(key, conn)
+        except OSError: pass
+    threading.Thread(target=connect, daemon=True).start()
+
+def _retry_delay(attempt, retry_after=None):
+    if retry_after:
+        try: return min(HTTP_BACKOFF_MAX, max(0.0, float(retry_after)))
+        except ValueError:
+            import email.utils
+            try: return min(HTTP_BACKOFF_MAX, max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()))
+            except (TypeError, ValueError): pass
+    import random
+    return min(HTTP_BACKOFF_MAX, HTTP_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+_RATE, _RATE_LOCK = {"interval": 0.0, "next": 0.0}, threading.Lock()  # shared request pacing for batch workers
+
+def rate_limit():
+    """Block until this thread may send the next API request (spaced by _RATE["interval"] across all threads)."""
+    with _RATE_LOCK:
+        now = time.monotonic(); slot = max(now, _RATE["next"]); _RATE["next"] = slot + _RATE["interval"]
+    if slot > now: time.sleep(slot - now)
+
+class HTTPStatusError(Exception):
+    def __init__(self, code, reason, body): super().__init__(f"HTTP {code}: {reason}"); self.code, self.reason, self.body = code, reason, body
+
+@contextlib.contextmanager
+def http_post(url, data, headers):
+    """POST over a pooled keep-alive connection, retrying 429/5xx and dropped connections with backoff.
+    A read timeout is not retried (the server already had HTTP_TIMEOUT to answer), and retries stop
+    once HTTP_RETRY_BUDGET is spent. Yields the response; the connection returns to the pool once the body is read."""
+    import http.client, socket, urllib.parse
+    key, u, give_up = _pool_key(url), urllib.parse.urlsplit(url), time.monotonic() + HTTP_RETRY_BUDGET
+    target = (u.path or "/") + (f"?{u.query}" if u.query else "")
+    for attempt in range(HTTP_RETRIES + 1):
+        rate_limit()  # every attempt, retries included, goes through the shared pacer
+        conn, reused = _acquire(key)
+        try:
+            conn.request("POST", url if conn.absolute_url else target, body=data, headers={**headers, **conn.proxy_headers})
+            resp = conn.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            if isinstance(e, (TimeoutError, socket.timeout)): raise
+            if reused and attempt < HTTP_RETRIES: continue  # stale keep-alive connection, retry straight away on a fresh one
+            delay = _retry_delay(attempt)
+            if attempt == HTTP_RETRIES or time.monotonic() + delay > give_up: raise
+            print(styled(f"\r{e}, retrying in {delay:.1f}s", "90m")); time.sleep(delay); continue
+        if resp.status >= 400:
+            body = resp.read()
+            (conn.close if resp.will_close else lambda: _release(key, conn))()
+            if resp.status in HTTP_RETRY_STATUS and attempt < HTTP_RETRIES and time.monotonic() + (delay := _retry_delay(attempt, resp.getheader("Retry-After"))) <= give_up:
+                print(styled(f"\rHTTP {resp.status}, retrying in {delay:.1f}s", "90m")); time.sleep(delay); continue
+            raise HTTPStatusError(resp.status, resp.reason, body)
+        try: yield resp
+        except BaseException: conn.close(); raise
+        try: resp.read(); (conn.close if resp.will_close else lambda: _release(key, conn))()
+        except (OSError, http.client.HTTPException): conn.close()
+        return
+
+EVENT_HEADER_SIZES = {0: 0, 1: 0, 2: 1, 3: 2, 4: 4, 5: 8, 8: 8, 9: 16}  # fixed-size header value types; 6/7 carry a 2-byte length
+
+def _event_headers(view):
+    headers, pos = {}, 0
+    while pos < len(view):
+        name_len = view[pos]; name = bytes(view[pos + 1:pos + 1 + name_len]).decode(); pos += 1 + name_len
+        kind = view[pos]; pos += 1
+        if kind in (6, 7):
+            size = struct.unpack_from('>H', view, pos)[0]; value = bytes(view[pos + 2:pos + 2 + size]); pos += 2 + size
+            headers[name] = value.decode('utf-8', errors='replace') if kind == 7 else value
+        elif kind in EVENT_HEADER_SIZES: headers[name] = kind == 0 if kind < 2 else bytes(view[pos:pos + EVENT_HEADER_SIZES[kind]]); pos += EVENT_HEADER_SIZES[kind]
+        else: raise ValueError(f"event stream: unknown header type {kind}")
+    return headers
+
+def parse_aws_event_stream(response, read_size=65536):
+    """Decode an AWS binary event stream, yielding (event_type, payload_dict) per message.
+    Reads into one reusable bytearray and checks the prelude and message CRCs; exception messages raise."""
+    buf, start, end = bytearray(read_size), 0, 0
     while True:
-        chunk = response.read(4096)
-        if not chunk and len(buffer) < 8: break
-        buffer += chunk
-        while len(buffer) >= 8:
-            total_len, headers_len = struct.unpack('>II', buffer[:8])
-            if len(buffer) < total_len: break
-            headers_start, headers_end = 12, 12 + headers_len
-            payload_data = buffer[headers_end:total_len - 4]
-            headers_data, event_type, pos = buffer[headers_start:headers_end], None, 0
-            while pos < len(headers_data):
-                try:
-                    name_len = headers_data[pos]; pos += 1
-                    name = headers_data[pos:pos + name_len].decode('utf-8'); pos += name_len
-                    header_type = headers_data[pos]; pos += 1
-                    if header_type == 7:
-                        value_len = struct.unpack('>H', headers_data[pos:pos + 2])[0]; pos += 2
-                        value = headers_data[pos:pos + value_len].decode('utf-8'); pos += value_len
-                        if name == ':event-type': event_type = value
-                    else: break
-                except: break
-            if payload_data and event_type == 'contentBlockDelta':
-                try:
-                    text = json.loads(payload_data.decode('utf-8')).get('delta', {}).get('text', '')
-                    if text: yield text
-                except: pass
-            buffer = buffer[total_len:]
+        need = 12
+        while end - start >= 12:
+            total_len, headers_len, prelude_crc = struct.unpack_from('>III', buf, start)
+            with memoryview(buf) as mv:
+                if zlib.crc32(mv[start:start + 8]) != prelude_crc: raise ValueError("event stream: prelude CRC mismatch")
+                if end - start < total_len: need = total_len; break
+                msg = mv[start:start + total_len]
+                if zlib.crc32(msg[:-4]) != struct.unpack_from('>I', msg, total_len - 4)[0]: raise ValueError("event stream: message CRC mismatch")
+                headers, payload = _event_headers(msg[12:12 + headers_len]), bytes(msg[12 + headers_len:-4])
+                msg.release()
+            start += total_len
+            try: data = json.loads(payload) if payload else {}
+            except ValueError: data = {"raw": payload}
+            kind = headers.get(':message-type', 'event')
+            if kind == 'exception': raise RuntimeError(f"{headers.get(':exception-type', 'exception')}: {data.get('message') or data.get('Message') or payload[:200]!r}")
+            if kind == 'error': raise RuntimeError(f"{headers.get(':error-code', 'error')}: {headers.get(':error-message', '')}")
+            yield headers.get(':event-type'), data
+        if start == end: start = end = 0
+        if len(buf) - end < max(need - (end - start), read_size // 4):
+            buf[:end - start] = buf[start:end]; end -= start; start = 0  # move the partial message to the front
+            if len(buf) - end < max(need - end, read_size // 4): buf.extend(bytes(max(need, len(buf))))
+        with memoryview(buf) as mv: n = response.readinto(mv[end:])
+        if not n: break
+        end += n
+
+BEDROCK_CACHE_MODELS = ("anthropic.", "amazon.nova")  # model families that accept cachePoint blocks
 
-def to_bedrock_messages(messages):
-    """Convert OpenAI-style messages to Bedrock format, returning (system_list, messages_list)"""
+def to_bedrock_messages(messages, cache=False):
+    """Convert OpenAI-style messages to Bedrock format, returning (system_list, messages_list).
+    Consecutive same-role messages are merged; with cache, a cachePoint follows every message marked "cache"."""
     system, msgs = [], []
     for m in messages:
         role, content = m.get('role'), m.get('content', '')
-        if role == 'system': system.append({"text": content})
-        elif role in ('user', 'assistant'): msgs.append({"role": role, "content": [{"text": content}]})
+        if role == 'system': blocks = system
+        elif role in ('user', 'assistant'):
+            if not msgs or msgs[-1]["role"] != role: msgs.append({"role": role, "content": []})
+            blocks = msgs[-1]["content"]
+        else: continue
+        blocks.append({"text": content})
+        if cache and m.get("cache"): blocks.append({"cachePoint": {"type": "default"}})
     return system, msgs
 
 def render_md(text):
@@ -180,138 +770,490 @@ def render_md(text):
             result.append(part)
     return ''.join(result)
 
+class ThreadStdout:
+    """sys.stdout replacement for batch mode: output from a thread with a stream set goes there, the rest to base."""
+    def __init__(self, base): self.base, self.local = base, threading.local()
+    def target(self): return getattr(self.local, "stream", None) or self.base
+    def write(self, text): return self.target().write(text)
+    def flush(self): self.target().flush()
+    def __getattr__(self, name): return getattr(self.target(), name)
+
+def current_stdout(): return sys.stdout.target() if isinstance(sys.stdout, ThreadStdout) else sys.stdout
+
+RENDER_FPS = 30  # max terminal writes per second while streaming
+
+class StreamRenderer:
+    """Incremental renderer for streamed markdown, code fences and TAGS xml.
+    Input is scanned once (only a short undecided tail is carried between chunks) and output is
+    coalesced into at most RENDER_FPS writes per second."""
+    TAG_RE = re.compile(r'<(/?(?:' + '|'.join(TAGS.values()) + r'))(?:\s[^>]*)?>')
+    TAG_PREFIX_RE = re.compile(r'</?([a-z_]*)')
+
+    def __init__(self, stream=None):
+        self.stream, self.out, self.lock, self.done = stream or current_stdout(), [], threading.Lock(), threading.Event()
+        self.pending, self.md, self.xml, self.code, self.bol = "", [], False, False, True
+        self.ticker = threading.Thread(target=self._tick, daemon=True); self.ticker.start()
+
+    def _tick(self):
+        while not self.done.wait(1 / RENDER_FPS): self.flush()
+
+    def flush(self):
+        with self.lock: data = "".join(self.out); self.out.clear()
+        if data: self.stream.write(data); self.stream.flush()
+
+    def _emit(self, text):
+        with self.lock: self.out.append(text)
+
+    def _code(self, text): self._emit(ansi('48;5;236;37m') + text.replace('\n', ansi('K') + '\n') + ansi('K'))
+
+    def _flush_md(self):
+        if self.md: self._emit(render_md("".join(self.md))); self.md = []
+
+    def _add_md(self, text):
+        """Buffer markdown until a paragraph break that doesn't leave inline markup open."""
+        prev = self.md[-1][-1:] if self.md else ""
+        self.md.append(text)
+        if '\n\n' not in prev + text: return
+        buffered = "".join(self.md); cut = buffered.rfind('\n\n')
+        last_line = buffered[buffered.rfind('\n', 0, cut) + 1:cut]
+        incomplete = (last_line.count('**') % 2 == 1 or
+                      (last_line.count('`') - last_line.count('```') * 3) % 2 == 1 or
+                      re.search(r'(?<!\*)\*[^*\n]+$', last_line) or
+                      re.search(r'(?<!\w)_[^_\n]+$', last_line))
+        if incomplete: self.md = [buffered]
+        else: self._emit(render_md(buffered[:cut + 2])); self.md = [buffered[cut + 2:]] if cut + 2 < len(buffered) else []
+
+    def _maybe_tag(self, tail):
+        """True if tail (starting at '<') could still turn into one of our tags once more text arrives."""
+        if len(tail) > 256: return False
+        m = self.TAG_PREFIX_RE.match(tail)
+        if m.end() == len(tail): return any(t.startswith(m.group(1)) for t in TAGS.values())
+        return m.group(1) in TAGS.values() and tail[m.end()].isspace() and '>' not in tail
+
+    def feed(self, chunk):
+        s, i, lt, nl = self.pending + chunk, 0, -1, -1
+        self.pending, n = "", len(s)
+        while i < n:
+            if self.bol and not self.xml:
+                if s.startswith('```', i):  # fence line: toggle code mode once the whole line is in
+                    j = s.find('\n', i)
+                    if j == -1: self.pending = s[i:]; return
+                    if self.code: self._emit(ansi('0m'))
+                    else: self._flush_md(); self._emit(ansi('48;5;236;37m'))
+                    self.code, i = not self.code, j + 1; continue
+                if '```'.startswith(s[i:]): self.pending = s[i:]; return
+            if nl < i: nl = s.find('\n', i); nl = n if nl == -1 else nl
+            if self.code:
+                self._code(s[i:nl + 1]); self.bol, i = nl < n, nl + 1; continue
+            if lt != n and lt < i: lt = s.find('<', i); lt = n if lt == -1 else lt
+            if nl < lt:
+                text, self.bol, i = s[i:nl + 1], nl < n, nl + 1
+            else:
+                text, self.bol, i = s[i:lt], False, lt
+                if lt < n:
+                    if m := self.TAG_RE.match(s, lt):
+                        (self._emit if self.xml else self._add_md)(text); self.xml or self._flush_md()
+                        tag, color = m.group(0), get_tag_color(m.group(0))
+                        self._emit(f"{ansi(color)}{tag}{ansi('0m')}" if color else tag)
+                        self.xml, i = not tag.startswith('</'), m.end(); continue
+                    if self._maybe_tag(s[lt:]): (self._emit if self.xml else self._add_md)(text); self.pending = s[lt:]; return
+                    text, i, lt = text + '<', lt + 1, -1
+            if text: (self._emit if self.xml else self._add_md)(text)
+
+    def finish(self):
+        """Emit whatever is still buffered, close any open code block and stop the ticker."""
+        if self.bol and not self.xml and self.pending.startswith('```'): self.pending = ""  # fence line without a trailing newline: closes the block below
+        if self.pending: (self._code if self.code else self._emit if self.xml else self._add_md)(self.pending); self.pending = ""
+        self._flush_md()
+        if self.code: self._emit(ansi('0m'))
+        self.done.set(); self.ticker.join(); self.flush()
+
 def truncate(lines, n=50, max_line_len=MAX_LINE_LENGTH):
     def trunc_line(line):
         return line if len(line) <= max_line_len else line[:max_line_len] + "..."
     lines = [trunc_line(line) for line in lines]
     return lines if len(lines) <= n else lines[:10] + ["[TRUNCATED]"] + lines[-40:]
 
-def run_shell_interactive(cmd):
-    output_lines, process = [], subprocess.Popen(cmd, shell=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+SHELL_TIMEOUT = float(os.getenv("NANOCODER_SHELL_TIMEOUT") or 0) or None  # wall-clock seconds per command, unset = no limit
+SHELL_MAX_BYTES = int(os.getenv("NANOCODER_SHELL_MAX_BYTES") or 0) or None  # stop a command after this much output
+SHELL_HEAD, SHELL_TAIL = 10, 40  # lines kept in memory; matches truncate()
+
+class ShellCapture:
+    """Command output in bounded memory: the first SHELL_HEAD and last SHELL_TAIL lines are kept,
+    the full output is spilled to an anonymous temp file for the [f]ull option."""
+    def __init__(self):
+        import tempfile
+        self.head, self.tail, self.lines, self.bytes, self.partial = [], collections.deque(maxlen=SHELL_TAIL), 0, 0, b""
+        self.spill = tempfile.TemporaryFile()
+
+    def _line(self, line):
+        self.lines += 1
+        (self.head if len(self.head) < SHELL_HEAD else self.tail).append(line)
+
+    def add(self, data):
+        self.spill.write(data); self.bytes += len(data)
+        *lines, self.partial = (self.partial + data).split(b"\n")
+        for line in lines: self._line(line.rstrip(b"\r").decode(errors="replace"))
+
+    def note(self, marker):
+        self.close(); self._line(marker); self.spill.write(f"\n{marker}\n".encode())
+
+    def close(self):
+        if self.partial: self._line(self.partial.rstrip(b"\r").decode(errors="replace")); self.partial = b""
+
+    def text(self, full=False):
+        if full: self.spill.seek(0); return self.spill.read().decode(errors="replace").rstrip("\n")
+        lines = self.head + (["[TRUNCATED]"] if self.lines > SHELL_HEAD + SHELL_TAIL else []) + list(self.tail)
+        return "\n".join(truncate(lines, n=len(lines)))
+
+def run_shell_interactive(cmd, timeout=SHELL_TIMEOUT, max_bytes=SHELL_MAX_BYTES):
+    """Run cmd, echoing its output in batched writes while capturing it. Returns (ShellCapture, returncode)."""
+    import codecs, queue, signal
+    capture, chunks, pending, stopped = ShellCapture(), queue.Queue(maxsize=64), [], threading.Event()  # at most 64 x 64KB in flight
+    try: tty = sys.stdin.fileno() if sys.stdin.isatty() and os.tcgetpgrp(sys.stdin.fileno()) == os.getpgrp() else None  # we own the terminal
+    except (OSError, ValueError): tty = None
+    def foreground(pgid):  # SIGTTOU blocked, so a background group may take the terminal
+        old = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTTOU})
+        try: os.tcsetpgrp(tty, pgid)
+        except OSError: pass
+        finally: signal.pthread_sigmask(signal.SIG_SETMASK, old)
+    def child():  # own process group so stop() reaches pipelines, made the terminal's foreground job so /dev/tty prompts (sudo, ssh, git) still work
+        os.setpgid(0, 0)
+        if tty is not None: foreground(os.getpgrp())
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=child)
+    def reader():
+        for chunk in iter(lambda: process.stdout.read1(65536), b""):
+            while not stopped.is_set():
+                try: chunks.put(chunk, timeout=0.1); break
+                except queue.Full: pass
+            if stopped.is_set(): return
+        chunks.put(None)
+    read_thread = threading.Thread(target=reader, daemon=True); read_thread.start()
+    def write():
+        if pending: sys.stdout.write("".join(pending)); sys.stdout.flush(); pending.clear()
+    def killpg(sig):
+        try: os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError): pass
+    def stop(marker):
+        stopped.set(); killpg(signal.SIGTERM)
+        try: process.wait(timeout=2)
+        except subprocess.TimeoutExpired: pass
+        killpg(signal.SIGKILL); process.wait()  # anything in the group that outlived SIGTERM
+        read_thread.join(timeout=1)
+        if not read_thread.is_alive(): process.stdout.close()
+        write(); capture.note(marker); print(f"\n{marker}")
+    decoder, deadline, last_write = codecs.getincrementaldecoder("utf-8")(errors="replace"), timeout and time.monotonic() + timeout, 0.0
     try:
-        for line in process.stdout: print(line, end="", flush=True); output_lines.append(line.rstrip('\n'))
-        process.wait()
-    except KeyboardInterrupt: process.terminate(); process.wait(timeout=2); output_lines.append("[INTERRUPTED]"); print("\n[INTERRUPTED]")
-    return output_lines, process.returncode
+        while True:
+            wait = 1 / RENDER_FPS if pending else None
+            if deadline: wait = max(0.0, min(wait or timeout, deadline - time.monotonic()))
+            try: chunk = chunks.get(timeout=wait)
+            except queue.Empty:
+                if deadline and time.monotonic() >= deadline: stop(f"[TIMEOUT after {timeout:g}s]"); break
+                write(); last_write = time.monotonic(); continue
+            if chunk is None: process.wait(); break
+            capture.add(chunk); pending.append(decoder.decode(chunk))
+            if time.monotonic() - last_write >= 1 / RENDER_FPS: write(); last_write = time.monotonic()
+            if max_bytes and capture.bytes >= max_bytes: stop(f"[OUTPUT LIMIT {max_bytes} bytes]"); break
+    except KeyboardInterrupt: stop("[INTERRUPTED]")
+    finally:
+        if tty is not None: foreground(os.getpgrp())
+    if process.returncode == -signal.SIGINT: capture.note("[INTERRUPTED]")  # Ctrl-C went to the command's foreground group, not to us
+    pending.append(decoder.decode(b"", final=True)); write(); capture.close()
+    return capture, process.returncode
+
+def usage_summary(meta):
+    """Normalize OpenAI usage / Bedrock metadata into {label: value} for display."""
+    usage, out = meta.get("usage") or {}, {}
+    if (tokens_in := usage.get("prompt_tokens", usage.get("inputTokens"))) is not None: out["in"] = tokens_in
+    if cached := (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or usage.get("cacheReadInputTokens"): out["cached"] = cached
+    if written := usage.get("cacheWriteInputTokens"): out["cache write"] = written
+    if (tokens_out := usage.get("completion_tokens", usage.get("outputTokens"))) is not None: out["out"] = tokens_out
+    if meta.get("latency_ms") is not None: out["server"] = f"{meta['latency_ms']}ms"
+    if meta.get("stop") not in (None, "stop", "end_turn"): out["stop"] = meta["stop"]
+    return out
 
-def stream_chat(messages, model):
+def stream_chat(messages, model, spinner=True):
     api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key: print(styled("Err: Missing OPENAI_API_KEY", "31m")); return None, False
+    if not api_key: print(styled("Err: Missing OPENAI_API_KEY", "31m")); return None, False, {}
     base_url = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
-    stop_event, full_response, buffer, md_buffer = threading.Event(), "", "", ""
-    state = {"xml": False, "code": False, "int": False}
-    tag_re = re.compile(r'<(/?(?:' + '|'.join(TAGS.values()) + r'))(?:\s[^>]*)?>')
+    stop_event, full_response, renderer, interrupted, meta = threading.Event(), "", None, False, {}
     def spin():
         i = 0; print()
-        while not stop_event.is_set(): print(f"\r{styled(' AI ', '47;30m')} {'⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏'[i % 10]} ", end="", flush=True); time.sleep(0.1); i += 1
-    def out(txt, code=False): print((f"{ansi('48;5;236;37m')}" + '\n'.join(f"{ln}{ansi('K')}" for ln in txt.split('\n'))) if code else render_md(txt), end="", flush=True)
-    def try_flush():
-        nonlocal md_buffer
-        if '\n\n' in md_buffer:
-            parts = md_buffer.rsplit('\n\n', 1)
-            to_flush = parts[0]
-            last_line = to_flush.split('\n')[-1] if to_flush else ""
-            incomplete = (last_line.count('**') % 2 == 1 or 
-                         (last_line.count('`') - last_line.count('```') * 3) % 2 == 1 or
-                         re.search(r'(?<!\*)\*[^*\n]+$', last_line) or
-                         re.search(r'(?<!\w)_[^_\n]+$', last_line))
-            if not incomplete:
-                out(parts[0] + '\n\n'); md_buffer = parts[1] if len(parts) > 1 else ""
+        while not stop_event.is_set(): print(f"\r{styled(' AI ', '47;30m')} {'⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏'[i % 10]} ", end="", flush=True); stop_event.wait(0.1); i += 1
     def chunk_iter(resp):
         if is_bedrock(base_url):
-            for text in parse_aws_event_stream(resp): yield text
+            for event, data in parse_aws_event_stream(resp):
+                if event == 'contentBlockDelta': yield data.get('delta', {}).get('text', '')
+                elif event == 'messageStop': meta["stop"] = data.get('stopReason')
+                elif event == 'metadata': meta["usage"] = data.get('usage', {}); meta["latency_ms"] = data.get('metrics', {}).get('latencyMs')
         else:
             for line in resp:
                 if not line.startswith(b"data: "): continue
-                try: yield json.loads(line[6:])["choices"][0]["delta"].get("content", "")
+                try:
+                    data = json.loads(line[6:])
+                    if data.get("usage"): meta["usage"] = data["usage"]
+                    if not data.get("choices"): continue
+                    choice = data["choices"][0]
+                    if choice.get("finish_reason"): meta["stop"] = choice["finish_reason"]
+                    yield choice.get("delta", {}).get("content") or ""
                 except: pass
-    spinner = threading.Thread(target=spin, daemon=True); spinner.start()
+    spinner = threading.Thread(target=spin if spinner else stop_event.wait, daemon=True); spinner.start()
     if is_bedrock(base_url):
-        system, bedrock_msgs = to_bedrock_messages(messages)
+        system, bedrock_msgs = to_bedrock_messages(messages, cache=any(family in model for family in BEDROCK_CACHE_MODELS))
         url = f"{base_url.rstrip('/')}/model/{model}/converse-stream"
         payload = {"messages": bedrock_msgs, "inferenceConfig": {"maxTokens": 16384}}
         if system: payload["system"] = system
     else:
         url = f"{base_url}/chat/completions"
-        payload = {"model": model, "messages": messages, "stream": True}
-    req = urllib.request.Request(url, headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json", "User-Agent": f"nanocoder/{VERSION}"}, data=json.dumps(payload).encode())
+        payload = {"model": model, "messages": [{k: v for k, v in m.items() if k != "cache"} for m in messages], "stream": True, "stream_options": {"include_usage": True}}
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json", "User-Agent": f"nanocoder/{VERSION}"}
+    data, started = json.dumps(payload).encode(), time.perf_counter()
     try:
-        with urllib.request.urlopen(req) as resp:
-            started = False
+        with http_post(url, data, headers) as resp:
+            record_span("connect", (first := time.perf_counter()) - started, request_bytes=len(data))
             for chunk in chunk_iter(resp):
-                if not started: stop_event.set(); spinner.join(); print(f"\r{styled(' AI ', '47;30m')}   \n", end="", flush=True); started = True
-                if chunk:
-                    full_response += chunk; buffer += chunk
-                    while buffer:
-                        fence = re.match(r'^(```[^\n]*\n?)', buffer) if not state["xml"] else None
-                        if not fence and not state["xml"] and '\n```' in buffer: fence = re.match(r'^(\n```[^\n]*\n?)', buffer[buffer.find('\n```'):])
-                        if fence and not state["xml"]:
-                            pos = buffer.find(fence.group(0))
-                            if state["code"]: out(buffer[:pos] + ansi('0m'), True)
-                            else: md_buffer += buffer[:pos]; out(md_buffer); md_buffer = ""
-                            state["code"] = not state["code"]
-                            if state["code"]: print(f"{ansi('48;5;236;37m')}", end="", flush=True)
-                            buffer = buffer[pos + len(fence.group(0)):]; continue
-                        match = tag_re.search(buffer)
-                        if match and not state["code"]:
-                            before = buffer[:match.start()]
-                            if state["xml"]: print(before, end="", flush=True)
-                            else: md_buffer += before; out(md_buffer); md_buffer = ""
-                            tag, color = match.group(0), get_tag_color(match.group(0))
-                            print(f"{ansi(color)}{tag}{ansi('0m')}" if color else tag, end="", flush=True)
-                            state["xml"] = not tag.startswith('</'); buffer = buffer[match.end():]
-                        else:
-                            lt = buffer.rfind('<') if not state["code"] else -1
-                            if lt != -1 and not state["xml"]: md_buffer += buffer[:lt]; try_flush(); buffer = buffer[lt:]
-                            elif state["xml"]:
-                                if lt != -1: print(buffer[:lt], end="", flush=True); buffer = buffer[lt:]
-                                else: print(buffer, end="", flush=True); buffer = ""
-                            elif state["code"]: out(buffer, True); buffer = ""
-                            else: md_buffer += buffer; try_flush(); buffer = ""
-                            break
-            if buffer: (print(buffer, end="", flush=True) if state["xml"] else out(buffer, state["code"]) if state["code"] else (md_buffer := md_buffer + buffer, out(md_buffer)))
-            elif md_buffer: out(md_buffer)
-            if state["code"]: print(ansi('0m'), end="", flush=True)
-    except KeyboardInterrupt: stop_event.set(); spinner.join(); state["int"] = True; md_buffer and out(md_buffer); state["code"] and print(ansi('0m'), end="", flush=True); print(f"\n{styled('[user interrupted]', '93m')}")
-    except urllib.error.HTTPError as e:
-        stop_event.set(); spinner.join()
-        error_body = ""
-        try: error_body = e.read().decode('utf-8', errors='replace')[:500]
-        except: pass
+                if not renderer: stop_event.set(); spinner.join(); print(f"\r{styled(' AI ', '47;30m')}   \n", end="", flush=True); renderer = StreamRenderer(); record_span("ttft", (first := time.perf_counter()) - started)
+                if chunk: full_response += chunk; renderer.feed(chunk)
+            renderer and renderer.finish()
+        elapsed, usage = time.perf_counter() - first, meta.get("usage") or {}
+        tokens = usage.get("completion_tokens", usage.get("outputTokens")) or len(full_response) // 4
+        record_span("streaming", elapsed, response_chars=len(full_response), tokens=tokens, tokens_per_s=round(tokens / elapsed, 1) if elapsed > 0 else None)
+    except KeyboardInterrupt: stop_event.set(); spinner.join(); interrupted = True; renderer and renderer.finish(); print(f"\n{styled('[user interrupted]', '93m')}")
+    except HTTPStatusError as e:
+        stop_event.set(); spinner.join(); renderer and renderer.finish()
+        error_body = e.body.decode('utf-8', errors='replace')[:500]
         print(f"\n{styled(f'HTTP {e.code}: {e.reason}', '31m')}")
         if error_body: print(styled(f"Response: {error_body}", '31m'))
-    except Exception as e: stop_event.set(); spinner.join(); print(f"\n{styled(f'Err: {e}', '31m')}")
-    print("\n"); return full_response, state["int"]
+    except Exception as e: stop_event.set(); spinner.join(); renderer and renderer.finish(); print(f"\n{styled(f'Err: {e}', '31m')}")
+    print("\n")
+    if summary := usage_summary(meta): print(styled(" " + " · ".join(f"{k} {v}" for k, v in summary.items()) + " ", "90m"))
+    return full_response, interrupted, meta
+
+EDIT_RE = re.compile(rf'<{TAGS["create"]} path="(.*?)">(.*?)</{TAGS["create"]}>|<{TAGS["edit"]} path="(.*?)">\s*<{TAGS["find"]}>(.*?)</{TAGS["find"]}>\s*<{TAGS["replace"]}>(.*?)</{TAGS["replace"]}>\s*</{TAGS["edit"]}>', re.DOTALL)
+
+def find_span(content, find):
+    """Locate find in content, returning (start, end) or None. Exact match first; otherwise whole lines
+    compared with whitespace normalized, so re-indented or re-wrapped find text still lands."""
+    if (i := content.find(find)) != -1: return i, i + len(find)
+    norm = lambda line: " ".join(line.split())
+    want = [norm(line) for line in find.splitlines()]
+    if not any(want): return None
+    lines, offsets, pos = content.splitlines(keepends=True), [], 0
+    for line in lines: offsets.append(pos); pos += len(line)
+    first = {}  # normalized line -> line numbers, built once per lookup
+    for k, line in enumerate(lines): first.setdefault(norm(line), []).append(k)
+    for k in first.get(want[0], ()):
+        if k + len(want) <= len(lines) and all(norm(lines[k + j]) == w for j, w in enumerate(want)):
+            last = lines[k + len(want) - 1]
+            return offsets[k] + len(lines[k]) - len(lines[k].lstrip()), offsets[k + len(want) - 1] + len(last.rstrip())
+    return None
 
 def apply_edits(text, root):
-    changes, p = 0, lambda path: Path(root, path)
-    def lint_py(path, content):
-        if not path.endswith(".py"): return True
-        try: ast.parse(content); return True
-        except SyntaxError as e: print(styled(f"Lint Fail {path}: {e}", "31m")); return False
-    for path, content in re.findall(rf'<{TAGS["create"]} path="(.*?)">(.*?)</{TAGS["create"]}>', text, re.DOTALL):
-        if p(path).exists(): print(styled(f"Skip create {path} (exists)", "31m")); continue
-        content = content.strip()
-        if not lint_py(path, content): continue
-        try: p(path).parent.mkdir(parents=True, exist_ok=True); p(path).write_text(content); [print(styled(f"+{ln}", "32m")) for ln in content.splitlines()]; print(styled(f"Created {path}", "32m")); changes += 1
-        except (PermissionError, OSError) as e: print(styled(f"Failed {path}: {e}", "31m"))
-    for path, find_text, replace_text in re.findall(rf'<{TAGS["edit"]} path="(.*?)">\s*<{TAGS["find"]}>(.*?)</{TAGS["find"]}>\s*<{TAGS["replace"]}>(.*?)</{TAGS["replace"]}>\s*</{TAGS["edit"]}>', text, re.DOTALL):
-        if not p(path).exists(): print(styled(f"Skip {path} (not found)", "31m")); continue
-        content = p(path).read_text()
-        if find_text.strip() not in content: print(styled(f"Match failed in {path}", "31m")); continue
-        new_content = content.replace(find_text.strip(), replace_text.strip(), 1)
-        if not lint_py(path, new_content) or content == new_content: continue
-        [print(styled(d, '32m' if d.startswith('+') else '31m' if d.startswith('-') else '0m')) for d in difflib.unified_diff(content.splitlines(), new_content.splitlines(), lineterm="") if not d.startswith(('---','+++'))]
-        try: p(path).write_text(new_content); print(styled(f"Applied {path}", "32m")); changes += 1
-        except (PermissionError, OSError) as e: print(styled(f"Failed {path}: {e}", "31m"))
+    """Apply all create/edit blocks in one transaction: edits are grouped per file and applied in memory,
+    each file is linted once, and files are written atomically only if every block succeeded.
+    Returns (changed paths, errors); any error means nothing was written."""
+    files, errors = {}, []  # path -> [original content (None when created), new content]
+    for m in EDIT_RE.finditer(text):
+        if m.group(1) is not None:
+            path, content = m.group(1), m.group(2).strip()
+            if path in files or Path(root, path).exists(): errors.append(f"Skip create {path} (exists)"); continue
+            files[path] = [None, content]; continue
+        path, find_text, replace_text = m.group(3), m.group(4).strip(), m.group(5).strip()
+        if path not in files:
+            try: original = read_cached(Path(root, path))
+            except FileNotFoundError: errors.append(f"Skip {path} (not found)"); continue
+            except (OSError, UnicodeDecodeError) as e: errors.append(f"Failed {path}: {e}"); continue
+            files[path] = [original, original]
+        content = files[path][1]
+        if not (found := find_span(content, find_text)): errors.append(f"Match failed in {path}: {find_text.splitlines()[0][:80] if find_text else ''!r}"); continue
+        files[path][1] = content[:found[0]] + replace_text + content[found[1]:]
+    changed = {path: (old, new) for path, (old, new) in files.items() if old != new}
+    with span("lint", files=len(changed)):
+        import ast
+        for path, (_, new) in changed.items():
+            if not path.endswith(".py"): continue
+            try: ast.parse(new)
+            except SyntaxError as e: errors.append(f"Lint Fail {path}: {e}")
+    if errors:
+        for error in errors: print(styled(error, "31m"))
+        if changed: print(styled(f"No changes applied ({len(errors)} failed, {len(changed)} file(s) left untouched)", "31m"))
+        return [], errors
+    import difflib
+    written = []
+    try:
+        for path, (old, new) in changed.items():
+            if old is None: [print(styled(f"+{ln}", "32m")) for ln in new.splitlines()]
+            else: [print(styled(d, '32m' if d.startswith('+') else '31m' if d.startswith('-') else '0m')) for d in difflib.unified_diff(old.splitlines(), new.splitlines(), lineterm="") if not d.startswith(('---','+++'))]
+            write_cached(Path(root, path), new); written.append(path)
+    except (PermissionError, OSError) as e:
+        errors.append(f"Failed {path}: {e}"); print(styled(errors[-1], "31m"))
+        for path in written:  # roll back what was already written
+            try: Path(root, path).unlink() if changed[path][0] is None else write_cached(Path(root, path), changed[path][0])
+            except OSError as e: print(styled(f"Rollback failed {path}: {e}", "31m"))
+        print(styled("No changes applied", "31m")); return [], errors
+    for path, (old, _) in changed.items(): print(styled(f"{'Created' if old is None else 'Applied'} {path}", "32m"))
     commit_msg = (m.group(1).strip() if (m := re.search(rf'<{TAGS["commit"]}>(.*?)</{TAGS["commit"]}>', text, re.DOTALL)) else 'Update')
-    if changes: run(f"git add -A && git commit -m {commit_msg!r}")
+    if changed:
+        import shlex
+        with span("commit"): run(f"git -C {shlex.quote(str(root))} add -A && git -C {shlex.quote(str(root))} commit -m {shlex.quote(commit_msg)}")
+    return list(changed), errors
+
+EDIT_RETRIES = 2  # interactive rounds in a row that may resend failed edits before the user gets the prompt back
+
+def edit_followup(errors):
+    return [f"Edits NOT applied (nothing from that response was written; resend all edits):\n" + "\n".join(errors)] if errors else []
+
+def handle_file_requests(response, root, context_files, confirm_large=False):
+    """Apply request_files/drop_files blocks from a response to context_files. Returns the newly added paths."""
+    added_files = []
+    for tag, content in re.findall(rf'<({TAGS["request"]}|{TAGS["drop"]})>(.*?)</\1>', response, re.DOTALL):
+        for filepath in content.strip().split('\n'):
+            filepath = filepath.strip()
+            if not filepath: continue
+            if tag == TAGS["request"] and filepath not in context_files:
+                content, error = safe_read_file(filepath, root, confirm_large=confirm_large)
+                if error:
+                    print(styled(f"Cannot add {filepath}: {error}", "31m"))
+                else:
+                    added_files.append(filepath)
+            elif tag == TAGS["drop"]:
+                context_files.discard(filepath)
+    context_files.update(added_files)
+    return added_files
+
+def build_messages(root, context_files, history, request, seen=None):
+    """Assemble a request whose large, slow-changing part forms a stable prefix for provider prompt caching:
+    system prompt + AGENTS.md + system summary, then context files in sorted order, then history (with a cache point
+after it). The repo map is personalized per request, so it goes in the final user message, after everything cached.
+    seen maps path -> (base, last_sent): the version embedded in the prefix and the latest one the model has
+    received. Files changed since then are sent in the turn as a unified diff (or in full when the diff is larger).
+    Returns (messages, turn, seen): turn is the user content to record in history, seen the state to keep once it is."""
+    agents_md = load_agents_md(root)
+    with span("system_summary"): summary = json.dumps(system_summary(), separators=(',',':'))
+    system_prompt = SYSTEM_PROMPT + (f"\n\n### Project Instructions (AGENTS.md)\n{agents_md}" if agents_md else "") + f"\n\nSystem summary: {summary}"
+    messages, current, updates, unchanged = [{"role": "system", "content": system_prompt, "cache": True}], {}, [], []
+    for f in sorted(context_files):
+        content, error = safe_read_file(f, root)
+        if error != "not found": current[f] = content if not error else f"[{error}]"
+    seen = {f: seen[f] if seen and f in seen else (content, content) for f, content in current.items()}
+    for f, content in current.items():
+        base, sent = seen[f]
+        if content == sent: unchanged.append(f); continue
+        import difflib
+        diff = "\n".join(difflib.unified_diff(sent.splitlines(), content.splitlines(), f"a/{f}", f"b/{f}", lineterm=""))
+        updates.append(f"File: {f} (changed since last sent, diff)\n```diff\n{diff}\n```" if len(diff) < len(content) else f"File: {f} (changed since last sent, full)\n```\n{content}\n```")
+        seen[f] = (base, content)
+    if seen:
+        messages.append({"role": "system", "content": "### Files\n" + "\n".join(f"File: {f}\n```\n{base}\n```" for f, (base, _) in seen.items()), "cache": True})
+    with span("get_map"): repo_map = get_map(root, context_files, request)
+    now = datetime.datetime.now().astimezone()
+    day = now.day
+    suffix = "th" if 11 <= day <= 13 else {1: "st", 2: "nd", 3: "rd"}.get(day % 10, "th")
+    current_time = now.strftime(f"%A {day}{suffix} of %B %Y, %H:%M %Z")
+    file_updates = "### File updates\n" + "\n".join(updates) + (f"\nUnchanged: {', '.join(unchanged)}" if unchanged else "") + "\n" if updates else ""
+    history = history[:-1] + [{**history[-1], "cache": True}] if history else []
+    return messages + history + [{"role": "user", "content": f"### Repo Map\n{repo_map}\n\nCurrent time: {current_time}\n{file_updates}Request: {request}"}], file_updates + request, seen
+
+CONTEXT_BUDGET = int(os.getenv("NANOCODER_CONTEXT_BUDGET") or 100_000)  # tokens per request before old history is compacted
+COMPACT_TARGET = 0.75  # compact down to this fraction of the budget, so it happens once per several turns, not every turn
+COMPACT_KEEP = 4  # most recent history messages (two exchanges) always kept verbatim
+COMPACT_SUMMARY_TOKENS = 2000  # cap on the running summary of compacted exchanges
+_ENCODER = []  # [tiktoken encoding, or None until loaded / when unavailable]
+
+def _load_encoder():
+    try:
+        import tiktoken
+        model = os.getenv("OPENAI_MODEL", "gpt-4o")
+        _ENCODER[0] = tiktoken.get_encoding("o200k_base" if re.match(r'(gpt-4o|gpt-4\.1|gpt-5|o\d)', model) else "cl100k_base")
+    except Exception: pass
+
+def count_tokens(text):
+    """Token count for text: exact with tiktoken when installed, else a BPE-shaped estimate (words, digit groups, punctuation runs, line breaks).
+    The encoding is loaded in the background (get_encoding may download it, with no timeout); the estimate is used until it is ready."""
+    if not _ENCODER: _ENCODER.append(None); threading.Thread(target=_load_encoder, daemon=True).start()
+    if _ENCODER[0]: return len(_ENCODER[0].encode(text, disallowed_special=()))
+    words = re.findall(r'[A-Za-z]+', text)
+    return (len(words) + sum((len(w) - 4) // 4 for w in words if len(w) > 7) + len(re.findall(r'\d{1,3}', text))
+        + sum((len(p) + 1) // 2 for p in re.findall(r'[^\sA-Za-z\d]+', text)) + len(re.findall(r'\n\s*', text)))
+
+def count_message_tokens(messages): return sum(count_tokens(m["content"]) + 4 for m in messages)
+
+def summarize_exchange(user, assistant):
+    """One-line extractive summary of a request/response pair: the request, the gist of the answer and what it changed."""
+    request = user.rpartition("Request: ")[2] if "Request: " in user else user.split("### File updates", 1)[0]
+    if shell_run := re.match(r'Shell result:\n\$ (.+)\n(exit=\S+)', request): request = f"[shell result of `{shell_run.group(1)}`, {shell_run.group(2)}]"
+    request = re.sub(r'\s+', ' ', request).strip()
+    prose = re.sub(r'<(\w+)[^>]*>.*?</\1>', '', assistant, flags=re.DOTALL)
+    gist = re.sub(r'\s+', ' ', next((p for p in prose.split("\n\n") if p.strip()), "")).strip()
+    edited = sorted(set(re.findall(rf'<(?:{TAGS["edit"]}|{TAGS["create"]}) path="([^"]+)"', assistant)))
+    commit = re.search(rf'<{TAGS["commit"]}>(.*?)</{TAGS["commit"]}>', assistant, re.DOTALL)
+    shell = re.search(rf'<{TAGS["shell"]}>(.*?)</{TAGS["shell"]}>', assistant, re.DOTALL)
+    return (f"- User: {request[:200]}\n  Assistant: {gist[:300]}" + (f" [edited {', '.join(edited)}]" if edited else "")
+        + (f" [commit: {commit.group(1).strip()[:100]}]" if commit else "") + (f" [ran: {shell.group(1).strip()[:100]}]" if shell else ""))
+
+def compact_history(history, excess):
+    """Shrink history in place by about excess tokens, oldest first, in increasingly lossy passes: strip the bodies
+    of edits (already applied), fold shell outputs repeated later, then fold the oldest exchanges into a running summary.
+    The last COMPACT_KEEP messages are never touched. Returns the tokens saved."""
+    old, saved = len(history) - COMPACT_KEEP, 0
+    def shrink(i, content):
+        nonlocal saved
+        saved += count_tokens(history[i]["content"]) - count_tokens(content); history[i] = {**history[i], "content": content}
+    def strip_body(m):
+        if not m.group(3).strip() or re.fullmatch(r'\[\d+ lines, applied\]', m.group(3)): return m.group(0)
+        return f"{m.group(1)}[{m.group(3).strip().count(chr(10)) + 1} lines, applied]{m.group(4)}"
+    body_re = re.compile(rf'(<({TAGS["find"]}|{TAGS["replace"]}|{TAGS["create"]})\b[^>]*>)(.*?)(</\2>)', re.DOTALL)
+    for i in range(old):
+        if saved >= excess: return saved
+        if history[i]["role"] == "assistant": shrink(i, body_re.sub(strip_body, history[i]["content"]))
+    runs = []  # (message index, command, output start, output end, output) for every shell result in history
+    for i, m in enumerate(history):
+        if m["role"] != "user": continue
+        for run_match in re.finditer(r'^\$ (.+)\nexit=\S+\n', m["content"], re.MULTILINE):
+            end = m["content"].find("\nPlease continue.", run_match.end())
+            end = len(m["content"]) if end < 0 else end
+            runs.append((i, run_match.group(1), run_match.end(), end, m["content"][run_match.end():end]))
+    for n, (i, cmd, start, end, output) in reversed(list(enumerate(runs))):  # back to front, so earlier offsets in a message stay valid
+        if i >= old or output.startswith("[output folded"): continue
+        if any(later[1] == cmd or later[4] == output for later in runs[n + 1:]):
+            content = history[i]["content"]; shrink(i, content[:start] + "[output folded: repeated later in the conversation]" + content[end:])
+    if saved >= excess: return saved
+    header = "[Summary of earlier conversation; file contents and diffs from it are superseded by the current files]"
+    start = end = int(bool(history) and history[0]["content"].startswith(header))
+    lines, estimate = history[0]["content"].split("\n")[1:] if start else [], saved
+    while end < old and estimate < excess:
+        step = 2 if history[end]["role"] == "user" and end + 1 < old and history[end + 1]["role"] == "assistant" else 1
+        if step == 2: line = summarize_exchange(history[end]["content"], history[end + 1]["content"])
+        else: content = re.sub(r'\s+', ' ', history[end]["content"]); line = f"- {history[end]['role'].title()}: {content[:200]}"
+        estimate += sum(count_tokens(m["content"]) for m in history[end:end + step]) - count_tokens(line); lines.append(line); end += step
+    if end == start: return saved
+    while len(lines) > 1 and count_tokens("\n".join(lines)) > COMPACT_SUMMARY_TOKENS: lines.pop(0)
+    text = header + "\n" + "\n".join(lines)
+    saved += sum(count_tokens(m["content"]) for m in history[:end]) - count_tokens(text)
+    history[:end] = [{"role": "user", "content": text}]
+    return saved
+
+def fit_context(root, context_files, history, request, seen, budget=CONTEXT_BUDGET):
+    """build_messages, compacting history first when the request would exceed budget tokens.
+    Returns (messages, turn, seen, tokens). Compaction resets seen so context files are resent whole."""
+    messages, turn, next_seen = build_messages(root, context_files, history, request, seen)
+    if (tokens := count_message_tokens(messages)) > budget and len(history) > COMPACT_KEEP:
+        with span("compact") as attrs:
+            before, attrs["saved"] = tokens, compact_history(history, tokens - int(budget * COMPACT_TARGET))
+            seen.clear(); messages, turn, next_seen = build_messages(root, context_files, history, request, seen); tokens = count_message_tokens(messages)
+        print(styled(f"Compacted history: ~{before // 1000}k → ~{tokens // 1000}k tokens (budget {budget // 1000}k)", "90m"))
+    return messages, turn, next_seen, tokens
 
 def main():
-    repo_root, context_files, history = run("git rev-parse --show-toplevel") or os.getcwd(), set(), []
+    repo_root, context_files, history, seen = run("git rev-parse --show-toplevel") or os.getcwd(), set(), [], {}
     model = os.getenv("OPENAI_MODEL", "gpt-4o")
+    threading.Thread(target=system_summary, daemon=True).start()  # probe tools while the user types the first request
+    threading.Thread(target=get_map, args=(repo_root,), daemon=True).start()  # and load the repo map
+    count_tokens("")  # and the tokenizer
     print(f"{styled(' nanocoder v' + str(VERSION) + ' ', '47;30m')} {styled(' ' + model + ' ', '47;30m')} {styled(' ctrl+d to send ', '47;30m')}")
     while True:
+        if os.getenv("OPENAI_API_KEY") and os.getenv("NANOCODER_WARMUP", "1") != "0": warm_up(os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1'))
         title("❓ nanocoder"); print(f"\a{styled('❯ ', '1;34m')}", end="", flush=True); input_lines = []
         try:
             while True: input_lines.append(input())
@@ -344,7 +1286,7 @@ def main():
                 print(f"\n{styled('Copy this command:', '1m')}\n\n{cmd}\n")
                 print(styled(f"Size: {len(cmd)} chars", '90m'))
                 if any('API_KEY' in k for k in env_vars): print(styled("⚠ Warning: contains API key(s)!", '93m'))
-            commands = {"/add": cmd_add, "/drop": lambda: context_files.discard(arg), "/clear": lambda: (history.clear(), print("History cleared.")), "/undo": lambda: run("git reset --soft HEAD~1"), "/export": cmd_export, "/help": lambda: print("/add <glob> - Add files\n/drop <file> - Remove file\n/clear - Clear history\n/undo - Undo commit\n/export - Export as portable bash command\n/exit - Exit\n!<cmd> - Shell")}
+            commands = {"/add": cmd_add, "/drop": lambda: context_files.discard(arg), "/clear": lambda: (history.clear(), seen.clear(), print("History cleared.")), "/undo": lambda: run("git reset --soft HEAD~1"), "/export": cmd_export, "/stats": show_stats, "/help": lambda: print("/add <glob> - Add files\n/drop <file> - Remove file\n/clear - Clear history\n/undo - Undo commit\n/export - Export as portable bash command\n/stats - Show per-phase timings\n/exit - Exit\n!<cmd> - Shell")}
             if command == "/exit": print("Bye!"); title(""); break
             if command in commands: commands[command]()
             continue
@@ -352,59 +1294,41 @@ def main():
         if user_input.startswith("!"):
             shell_cmd = user_input[1:].strip()
             if shell_cmd:
-                output_lines, exit_code = run_shell_interactive(shell_cmd)
+                output, exit_code = run_shell_interactive(shell_cmd)
                 print(f"\n{styled(f'exit={exit_code}', '90m')}"); title("❓ nanocoder")
                 try: answer = input("\aAdd to context? [t]runcated/[f]ull/[n]o: ").strip().lower()
                 except (EOFError, KeyboardInterrupt): print(); answer = "n"
                 if answer in ("t", "f"):
-                    history.append({"role": "user", "content": f"$ {shell_cmd}\nexit={exit_code}\n" + "\n".join(truncate(output_lines) if answer == "t" else output_lines)})
+                    history.append({"role": "user", "content": f"$ {shell_cmd}\nexit={exit_code}\n" + output.text(full=answer == "f")})
                     print(styled("Added to context", "93m"))
             continue
 
-        request = user_input
+        request, edit_retries = user_input, 0
         while True:
-            def read(p):
-                content, error = safe_read_file(p, repo_root, confirm_large=False)
-                if error: return f"[{error}]"
-                return content
-            context = f"### Repo Map\n{get_map(repo_root)}\n### Files\n" + "\n".join(f"File: {f}\n```\n{read(f)}\n```" for f in context_files if Path(repo_root,f).exists())
-            agents_md = load_agents_md(repo_root)
-            now = datetime.datetime.now().astimezone()
-            day = now.day
-            suffix = "th" if 11 <= day <= 13 else {1: "st", 2: "nd", 3: "rd"}.get(day % 10, "th")
-            current_time = now.strftime(f"%A {day}{suffix} of %B %Y, %H:%M %Z")
-            system_prompt = SYSTEM_PROMPT + (f"\n\n### Project Instructions (AGENTS.md)\n{agents_md}" if agents_md else "")
-            messages = [{"role": "system", "content": system_prompt}, {"role": "system", "content": f"System summary: {json.dumps(system_summary(), separators=(',',':'))}\n\nCurrent time: {current_time}"}] + history + [{"role": "user", "content": f"{context}\nRequest: {request}"}]
-            title("⏳ nanocoder"); full_response, interrupted = stream_chat(messages, model)
-            if full_response is None: break
+            begin_turn(model=model, context_files=len(context_files), history_messages=len(history))
+            with span("context") as attrs: messages, turn, next_seen, attrs["tokens"] = fit_context(repo_root, context_files, history, request, seen)
+            title("⏳ nanocoder")
+            with span("stream"): full_response, interrupted, _ = stream_chat(messages, model)
+            if full_response is None: end_turn(); break
             response_content = full_response + ("\n\n[user interrupted]" if interrupted else "")
-            history.extend([{"role": "user", "content": request}, {"role": "assistant", "content": response_content}])
-            if interrupted: break
-            apply_edits(full_response, repo_root)
-            file_requests = re.findall(rf'<({TAGS["request"]}|{TAGS["drop"]})>(.*?)</\1>', full_response, re.DOTALL)
-            added_files = []
-            for tag, content in file_requests:
-                for filepath in content.strip().split('\n'):
-                    filepath = filepath.strip()
-                    if not filepath: continue
-                    if tag == TAGS["request"] and filepath not in context_files:
-                        content, error = safe_read_file(filepath, repo_root, confirm_large=True)
-                        if error:
-                            print(styled(f"Cannot add {filepath}: {error}", "31m"))
-                        else:
-                            added_files.append(filepath)
-                    elif tag == TAGS["drop"]:
-                        context_files.discard(filepath)
-            context_files.update(added_files)
+            history.extend([{"role": "user", "content": turn}, {"role": "assistant", "content": response_content}]); seen.clear(); seen.update(next_seen)
+            if interrupted: end_turn(); break
+            with span("apply_edits"): _, edit_errors = apply_edits(full_response, repo_root)
+            end_turn()
+            added_files = handle_file_requests(full_response, repo_root, context_files, confirm_large=True)
             def safe_read(fp):
-                try: return Path(repo_root, fp).read_text()
+                try: return read_cached(Path(repo_root, fp))
                 except: return ""
-            tok_hist = sum(len(m.get("content","")) for m in history)//4
-            tok_files = sum(len(safe_read(f)) for f in context_files if Path(repo_root,f).exists())//4
+            tok_hist = count_message_tokens(history)
+            tok_files = sum(count_tokens(safe_read(f)) for f in context_files)
             tok_total = tok_hist + tok_files
-            tok_bg = '47;30m' if tok_total < 80000 else '43;30m' if tok_total < 120000 else '41;37m'
-            print(styled(f" ~{tok_hist//1000}k hist, ~{tok_files//1000}k files ", tok_bg))
-            if added_files: print(styled(f"+{len(added_files)} file(s)", "93m")); request = f"Added files: {', '.join(added_files)}. Please continue."; continue
+            tok_bg = '47;30m' if tok_total < CONTEXT_BUDGET * 0.8 else '43;30m' if tok_total < CONTEXT_BUDGET else '41;37m'
+            print(styled(f" ~{tok_hist//1000}k hist, ~{tok_files//1000}k files / {CONTEXT_BUDGET//1000}k ", tok_bg))
+            if added_files: print(styled(f"+{len(added_files)} file(s)", "93m"))
+            edit_retries = edit_retries + 1 if edit_errors else 0
+            if edit_retries > EDIT_RETRIES: print(styled(f"Edits still failing after {EDIT_RETRIES} retries, stopping here.", "31m")); break
+            followups = edit_followup(edit_errors) + ([f"Added files: {', '.join(added_files)}."] if added_files else []) + ([f"Search results:\n{results}"] if (results := run_searches(full_response, repo_root)) else [])
+            if followups: request = "\n".join(followups + ["Please continue."]); continue
             shell_match = re.search(rf'<{TAGS["shell"]}>(.*?)</{TAGS["shell"]}>', full_response, re.DOTALL)
             if shell_match:
                 cmd = shell_match.group(1).strip()
@@ -412,9 +1336,98 @@ def main():
                 try: answer = input("\aRun? (y/n): ").strip().lower()
                 except (EOFError, KeyboardInterrupt): print(); answer = "n"
                 if answer == "y":
-                    try: output_lines, exit_code = run_shell_interactive(cmd); result = f"$ {cmd}\nexit={exit_code}\n" + "\n".join(truncate(output_lines))
+                    try: output, exit_code = run_shell_interactive(cmd); result = f"$ {cmd}\nexit={exit_code}\n" + output.text()
                     except Exception as err: result = f"$ {cmd}\nerror: {err}"
                     request = f"Shell result:\n{result}\nPlease continue."; continue
             break
 
-if __name__ == "__main__": main()
+_GIT_LOCK = threading.Lock()  # serializes worktree add/remove, which touch shared repo metadata
+
+def run_task(task, root, model, max_rounds, out_dir, keep_worktree=False, stop=None):
+    """Run one batch task in its own git worktree and branch, without prompting. Returns a result dict.
+    Setting the stop event ends the task after its current round."""
+    import shlex
+    task_id, started = task["id"], time.monotonic()
+    worktree, branch, base = out_dir / "worktrees" / task_id, f"nanocoder/{task_id}", run(f"git -C {shlex.quote(root)} rev-parse HEAD")
+    result = {"id": task_id, "branch": branch, "status": "error", "rounds": 0, "changed": [], "commits": 0, "tokens_in": 0, "tokens_out": 0}
+    with open(out_dir / f"{task_id}.log", "w") as log:
+        sys.stdout.local.stream = log
+        try:
+            with _GIT_LOCK: added = subprocess.run(["git", "-C", root, "worktree", "add", "-q", "-b", branch, str(worktree), base], capture_output=True, text=True)
+            if added.returncode: result["error"] = added.stdout + added.stderr; return result
+            context_files, history, seen, request, edit_errors = set(), [], {}, task["prompt"], []
+            for pattern in task.get("files", []):
+                context_files.update(f for f in glob.glob(pattern, root_dir=worktree, recursive=True) if Path(worktree, f).is_file() and not safe_read_file(f, worktree)[1])
+            for result["rounds"] in range(1, max_rounds + 1):
+                if stop and stop.is_set(): result["rounds"] -= 1; result["status"] = "interrupted"; break
+                begin_turn(model=model, task=task_id, round=result["rounds"])
+                with span("context") as attrs: messages, turn, next_seen, attrs["tokens"] = fit_context(str(worktree), context_files, history, request, seen)
+                with span("stream"): full_response, _, meta = stream_chat(messages, model, spinner=False)
+                usage = meta.get("usage") or {}
+                result["tokens_in"] += usage.get("prompt_tokens", usage.get("inputTokens")) or 0; result["tokens_out"] += usage.get("completion_tokens", usage.get("outputTokens")) or 0
+                if not full_response: end_turn(); result["error"] = "no response (see log)"; break
+                history.extend([{"role": "user", "content": turn}, {"role": "assistant", "content": full_response}]); seen = next_seen
+                with span("apply_edits"): changed, edit_errors = apply_edits(full_response, str(worktree))
+                result["changed"] += changed
+                end_turn()
+                added_files = handle_file_requests(full_response, str(worktree), context_files)
+                followups = edit_followup(edit_errors) + ([f"Added files: {', '.join(added_files)}."] if added_files else []) + ([f"Search results:\n{results}"] if (results := run_searches(full_response, str(worktree))) else [])
+                if followups: request = "\n".join(followups + ["Please continue."]); continue
+                if re.search(rf'<{TAGS["shell"]}>', full_response): request = "Shell commands are not available in batch mode. Please continue without running commands."; continue
+                result["status"] = "done"; break
+            else:
+                result["status"] = "edit_failed" if edit_errors else "max_rounds"  # the last round's edits never landed
+                if edit_errors: result["error"] = "; ".join(edit_errors)
+            result["commits"] = int(run(f"git -C {shlex.quote(str(worktree))} rev-list --count {base}..HEAD") or 0)
+        except Exception as e: result["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            sys.stdout.local.stream = None; result["seconds"] = round(time.monotonic() - started, 1)
+            if not keep_worktree and worktree.exists():
+                with _GIT_LOCK: subprocess.run(["git", "-C", root, "worktree", "remove", "--force", str(worktree)], capture_output=True)
+    result["changed"] = sorted(set(result["changed"]))
+    return result
+
+def batch_main(argv):
+    """Headless mode: run the tasks in a task file concurrently, each in its own git worktree and branch."""
+    import argparse, concurrent.futures, tempfile
+    parser = argparse.ArgumentParser(prog="nanocoder", description="Run nanocoder non-interactively over a task file. Each task runs in its own git worktree on branch nanocoder/<id>; edits are committed there.")
+    parser.add_argument("--batch", metavar="TASKS", required=True, help='JSONL with {"id", "prompt", "files": [globs]} per line, or one prompt per line')
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="tasks run in parallel (default 4)")
+    parser.add_argument("--rpm", type=float, default=0, help="max API requests per minute across all tasks (default unlimited)")
+    parser.add_argument("--max-rounds", type=int, default=8, help="model round trips per task (default 8)")
+    parser.add_argument("--out", help="directory for results.jsonl, per-task logs and worktrees (default: a new temp dir)")
+    parser.add_argument("--keep-worktrees", action="store_true", help="leave worktrees in place after each task")
+    args = parser.parse_args(argv)
+    if not (root := run("git rev-parse --show-toplevel")): print(styled("Err: batch mode must run inside a git repository", "31m")); return 2
+    if not os.getenv("OPENAI_API_KEY"): print(styled("Err: Missing OPENAI_API_KEY", "31m")); return 2
+    tasks, ids = [], set()
+    for n, line in enumerate(Path(args.batch).read_text().splitlines(), 1):
+        if not line.strip(): continue
+        task = json.loads(line) if line.lstrip().startswith("{") else {"prompt": line.strip()}
+        task_id = re.sub(r'[^\w.-]+', '-', str(task.get("id") or f"task-{n}")).strip('-.') or f"task-{n}"
+        while task_id in ids: task_id += "-dup"
+        ids.add(task_id); tasks.append({**task, "id": task_id})
+    out_dir = Path(args.out or tempfile.mkdtemp(prefix=f"nanocoder-batch-{Path(root).name}-")); out_dir.mkdir(parents=True, exist_ok=True)
+    model, _RATE["interval"] = os.getenv("OPENAI_MODEL", "gpt-4o"), 60 / args.rpm if args.rpm else 0.0
+    print(f"{styled(' nanocoder v' + str(VERSION) + ' batch ', '47;30m')} {len(tasks)} tasks, {args.jobs} jobs, model {model}\nResults: {out_dir}")
+    sys.stdout, stop, reported = ThreadStdout(sys.stdout), threading.Event(), {}  # future -> result
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs))
+    try:
+        with open(out_dir / "results.jsonl", "a") as results:
+            def report(futures):
+                for future in concurrent.futures.as_completed(futures):
+                    result = reported[future] = future.result()
+                    results.write(json.dumps(result) + "\n"); results.flush()
+                    print(f"[{len(reported)}/{len(tasks)}] {result['id']}: {styled(result['status'], '32m' if result['status'] == 'done' else '31m')} ({result['commits']} commit(s), {result['rounds']} round(s), {result['seconds']}s)" + (f" {result['error'].strip()[:200]}" if result.get("error") else ""))
+            futures = [pool.submit(run_task, task, root, model, args.max_rounds, out_dir, args.keep_worktrees, stop) for task in tasks]
+            try: report(futures)
+            except KeyboardInterrupt:
+                stop.set(); running = [f for f in futures if not f.cancel() and f not in reported]  # queued tasks are dropped
+                print(styled("\n[interrupted: waiting for running tasks to finish their current round; Ctrl-C again to quit now]", "93m"))
+                try: report(running)
+                except KeyboardInterrupt: os._exit(130)  # worker threads can't be interrupted; their worktrees stay behind
+    finally: sys.stdout = sys.stdout.base  # only once no worker can write any more
+    pool.shutdown()
+    return 130 if stop.is_set() else 1 if any(r["status"] != "done" for r in reported.values()) else 0
+
+if __name__ == "__main__": sys.exit(batch_main(sys.argv[1:])) if len(sys.argv) > 1 else main()